@@ -0,0 +1,87 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+
+from storage import atomic_write, dump_json
+
+logger = logging.getLogger(__name__)
+
+
+class FunnelAnalytics:
+    """Счётчики воронки записи.
+
+    Событие — шаг воронки ('start', 'level', ...) и, по желанию, измерения
+    (level='Новичок', slot='13:00-14:00'). Каждое событие увеличивает
+    счётчики 'step:<шаг>' и '<измерение>:<значение>' в корзине текущего
+    часа (последние 24 часа, только в памяти) и текущего дня (дневные итоги
+    хранятся keep_days дней и сохраняются в path). Отчёт за период — сумма
+    нескольких маленьких словарей, логи для него не нужны.
+    """
+
+    def __init__(self, path, keep_days=90):
+        self.path = path
+        self.keep_days = keep_days
+        self.days = {}  # 'YYYY-MM-DD' -> {ключ: число}
+        self.hours = {}  # номер часа от эпохи -> {ключ: число}
+        self.dirty = False
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.days = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logger.error(f"Analytics file {self.path} is damaged, starting over: {e}")
+        return self
+
+    def track(self, step, **dimensions):
+        keys = ['step:' + step] + [f'{name}:{value}' for name, value in dimensions.items() if value is not None]
+        hour = int(time.time() // 3600)
+        hour_bucket = self.hours.get(hour)
+        if hour_bucket is None:
+            hour_bucket = self.hours[hour] = {}
+            for old in [h for h in self.hours if h <= hour - 24]:
+                del self.hours[old]
+        today = datetime.now().date().isoformat()
+        day_bucket = self.days.get(today)
+        if day_bucket is None:
+            day_bucket = self.days[today] = {}
+            cutoff = (datetime.now().date() - timedelta(days=self.keep_days)).isoformat()
+            for old in [d for d in self.days if d < cutoff]:
+                del self.days[old]
+        for key in keys:
+            hour_bucket[key] = hour_bucket.get(key, 0) + 1
+            day_bucket[key] = day_bucket.get(key, 0) + 1
+        self.dirty = True
+
+    @staticmethod
+    def _sum(buckets):
+        totals = {}
+        for bucket in buckets:
+            for key, count in bucket.items():
+                totals[key] = totals.get(key, 0) + count
+        return totals
+
+    def last_hours(self, hours=24):
+        now = int(time.time() // 3600)
+        return self._sum(bucket for hour, bucket in self.hours.items() if hour > now - hours)
+
+    def last_days(self, days):
+        """Итоги за days дней, включая сегодняшний"""
+        since = (datetime.now().date() - timedelta(days=days - 1)).isoformat()
+        return self._sum(bucket for day, bucket in self.days.items() if day >= since)
+
+    async def flush(self):
+        """Сохраняет дневные итоги, если они менялись (запись — в отдельном потоке)"""
+        if not self.dirty:
+            return
+        self.dirty = False
+        data = dump_json(self.days)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, atomic_write, self.path, data)
+        except OSError as e:
+            self.dirty = True
+            logger.error(f"Analytics save error: {e}")
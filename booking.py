@@ -0,0 +1,138 @@
+import struct
+from datetime import date
+from enum import IntEnum
+
+
+class Level(IntEnum):
+    BEGINNER = 1
+    EXPERIENCED = 2
+
+    @property
+    def label(self):
+        return LEVEL_LABELS[self]
+
+
+class Instrument(IntEnum):
+    ELECTRIC = 1
+    ACOUSTIC = 2
+
+    @property
+    def label(self):
+        return INSTRUMENT_LABELS[self]
+
+
+class Timezone(IntEnum):
+    """Часовые пояса из клавиатуры; значение — смещение от UTC, CUSTOM — введённое вручную"""
+    UTC3 = 3
+    UTC4 = 4
+    UTC5 = 5
+    UTC7 = 7
+    UTC10 = 10
+    CUSTOM = 0
+
+    @property
+    def key(self):
+        """Ключ в callback_data: tz_<key>"""
+        return 'custom' if self is Timezone.CUSTOM else f'utc{self.value}'
+
+    @property
+    def label(self):
+        return TIMEZONE_LABELS[self]
+
+    @classmethod
+    def from_key(cls, key):
+        return next(tz for tz in cls if tz.key == key)
+
+
+LEVEL_LABELS = {Level.BEGINNER: 'Новичок', Level.EXPERIENCED: 'С опытом'}
+INSTRUMENT_LABELS = {Instrument.ELECTRIC: 'Электрогитара', Instrument.ACOUSTIC: 'Акустика/Классика'}
+TIMEZONE_LABELS = {
+    Timezone.UTC3: 'UTC+3 (Москва)',
+    Timezone.UTC4: 'UTC+4 (Самара)',
+    Timezone.UTC5: 'UTC+5 (Екатеринбург)',
+    Timezone.UTC7: 'UTC+7 (Красноярск/Новосибирск)',
+    Timezone.UTC10: 'UTC+10 (Владивосток)',
+    Timezone.CUSTOM: 'Другой часовой пояс',
+}
+
+# Разница с Москвой, которую можно ввести вручную (итог — от UTC-12 до UTC+14)
+CUSTOM_OFFSET_RANGE = range(-15, 12)
+
+
+class BookingSession:
+    """Ответы пользователя в воронке записи (хранится в user_data['booking']).
+
+    Только коды и дата; строки для показа (timezone_label и т.п.) собираются
+    по запросу. reached — пройденные шаги воронки (биты по STEPS), чтобы
+    аналитика считала каждый шаг один раз за попытку записи.
+    to_bytes/from_bytes — запись фиксированной длины для persistence.
+    """
+
+    __slots__ = ('level', 'instrument', 'timezone', 'custom_offset', 'date', 'date_offset', 'reached')
+
+    # Номер шага — номер бита в reached: порядок не менять, новое — в конец
+    STEPS = ('start', 'booking', 'level', 'instrument', 'timezone', 'day', 'booked', 'no_instrument')
+
+    # уровень, инструмент, пояс, смещение, дата (ordinal, 0 — нет), сдвиг дней, пройденные шаги
+    _FORMAT = struct.Struct('<BBBbIBH')
+    _OLD_SIZE = struct.calcsize('<BBBbIB')  # записи без reached
+
+    def __init__(self, level=None, instrument=None, timezone=None, custom_offset=0, date=None, date_offset=0,
+                 reached=0):
+        self.level = level
+        self.instrument = instrument
+        self.timezone = timezone
+        self.custom_offset = custom_offset  # разница с Москвой для Timezone.CUSTOM
+        self.date = date
+        self.date_offset = date_offset  # первый показанный день в клавиатуре дней
+        self.reached = reached
+
+    def reach(self, step):
+        """Отмечает шаг воронки. True, если в этой попытке он пройден впервые"""
+        bit = 1 << self.STEPS.index(step)
+        if self.reached & bit:
+            return False
+        self.reached |= bit
+        return True
+
+    def has_reached(self, step):
+        return bool(self.reached & 1 << self.STEPS.index(step))
+
+    def set_timezone(self, timezone, custom_offset=0):
+        self.timezone = timezone
+        self.custom_offset = custom_offset
+        self.date_offset = 0
+
+    @property
+    def timezone_label(self):
+        if self.timezone is Timezone.CUSTOM:
+            offset = self.custom_offset
+            return f"UTC{'+' if offset >= 0 else ''}{offset + 3} (Москва{'+' if offset >= 0 else ''}{offset})"
+        return self.timezone.label if self.timezone is not None else None
+
+    @property
+    def level_label(self):
+        return self.level.label if self.level is not None else None
+
+    @property
+    def instrument_label(self):
+        return self.instrument.label if self.instrument is not None else None
+
+    def to_bytes(self):
+        return self._FORMAT.pack(self.level or 0, self.instrument or 0,
+                                 self.timezone if self.timezone is not None else 0xFF, self.custom_offset,
+                                 self.date.toordinal() if self.date else 0, self.date_offset, self.reached)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if len(data) == cls._OLD_SIZE:
+            data = bytes(data) + bytes(cls._FORMAT.size - cls._OLD_SIZE)
+        level, instrument, timezone, custom_offset, ordinal, date_offset, reached = cls._FORMAT.unpack(data)
+        return cls(Level(level) if level else None, Instrument(instrument) if instrument else None,
+                   Timezone(timezone) if timezone != 0xFF else None, custom_offset,
+                   date.fromordinal(ordinal) if ordinal else None, date_offset, reached)
+
+    def __repr__(self):
+        return (f'BookingSession(level={self.level!r}, instrument={self.instrument!r}, timezone={self.timezone!r}, '
+                f'custom_offset={self.custom_offset}, date={self.date!r}, date_offset={self.date_offset}, '
+                f'reached={self.reached:#x})')
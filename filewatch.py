@@ -0,0 +1,122 @@
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+
+from storage import file_signature
+
+logger = logging.getLogger(__name__)
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len (за ним имя длиной len)
+
+
+class FileWatcher:
+    """Вызывает async callback(), когда файл path изменился.
+
+    На Linux — inotify на каталоге (файл часто заменяют целиком через
+    rename, и наблюдение за самим файлом после этого теряется), иначе —
+    опрос mtime/размера раз в interval секунд. Серия событий за debounce
+    секунд (редактор пишет файл в несколько приёмов) даёт один вызов;
+    вызовы не пересекаются.
+    """
+
+    def __init__(self, path, callback, interval=2.0, debounce=0.3):
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.interval = interval
+        self.debounce = debounce
+        self.mode = None  # 'inotify' | 'poll'
+        self._fd = None
+        self._poll_task = None
+        self._timer = None
+        self._running = None
+        self._pending = False
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        try:
+            self._fd = self._inotify_init()
+            loop.add_reader(self._fd, self._read_events)
+            self.mode = 'inotify'
+        except (OSError, AttributeError) as e:
+            logger.info(f"inotify is not available ({e}), polling {self.path} every {self.interval}s")
+            self._poll_task = loop.create_task(self._poll(file_signature(self.path)))
+            self.mode = 'poll'
+
+    def _inotify_init(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(fd, os.path.dirname(self.path).encode(), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, 'inotify_add_watch failed')
+        return fd
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        name = os.path.basename(self.path).encode()
+        pos = 0
+        while pos < len(data):
+            _, _, _, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            if data[pos:pos + length].rstrip(b'\0') == name:
+                self._changed()
+            pos += length
+
+    async def _poll(self, last):
+        while True:
+            await asyncio.sleep(self.interval)
+            signature = file_signature(self.path)
+            if signature != last:
+                last = signature
+                self._changed()
+
+    def _changed(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(self.debounce, self._fire)
+
+    def _fire(self):
+        self._timer = None
+        if self._running is not None and not self._running.done():
+            self._pending = True  # повторим, когда закончится текущий вызов
+            return
+        self._running = asyncio.get_running_loop().create_task(self._run_callback())
+
+    async def _run_callback(self):
+        while True:
+            self._pending = False
+            try:
+                await self.callback()
+            except Exception as e:
+                logger.error(f"File watcher callback error for {self.path}: {e}")
+            if not self._pending:
+                return
+
+    async def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            try:
+                await self._poll_task
+            except asyncio.CancelledError:
+                pass
+        if self._running is not None and not self._running.done():
+            await self._running
@@ -0,0 +1,85 @@
+import atexit
+import json
+import logging
+import queue
+import sys
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+# Поля, которые передаются через extra={...} и попадают в JSON отдельными ключами
+FIELDS = ('user_id', 'username', 'action', 'state', 'latency_ms')
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """QueueHandler, который не форматирует запись у себя: и сообщение, и JSON
+    собираются в потоке QueueListener, а не на event loop"""
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level=logging.INFO, fmt='json', stream=None):
+    """Вешает на корневой логгер очередь; вывод делает отдельный поток.
+    fmt='text' — прежний человекочитаемый формат"""
+    handler = logging.StreamHandler(stream or sys.stderr)
+    if fmt == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, handler, respect_handler_level=True)
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(_DeferredQueueHandler(records))
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)  # дописывает очередь при выходе
+    return listener
+
+
+class ActionSampler:
+    """Выборочное логирование частых действий.
+
+    rates: {'Start': 0.1, ...} — доля пользователей, чьи действия пишутся.
+    Решение зависит от user_id, а не от случая, поэтому для попавшего в
+    выборку пользователя видна вся его воронка целиком.
+    """
+
+    def __init__(self, rates=None, default=1.0):
+        self.rates = rates or {}
+        self.default = default
+
+    @classmethod
+    def parse(cls, spec):
+        """'Start=0.1,Level=0.5' -> ActionSampler"""
+        rates = {}
+        for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+            action, _, rate = item.partition('=')
+            rates[action.strip()] = float(rate)
+        return cls(rates)
+
+    def keep(self, action, user_id):
+        rate = self.rates.get(action, self.default)
+        if rate >= 1:
+            return True
+        return (user_id * 2654435761 % 2 ** 32) / 2 ** 32 < rate
@@ -1,19 +1,99 @@
+import asyncio
 import logging
 import os
+import secrets
+import signal
+import socket
+import time
+import functools
 import json
+from collections import OrderedDict
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes, ConversationHandler
 from datetime import datetime, timedelta
-
-# Логирование
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+from storage import JsonScheduleStorage, ScheduleArchive, SqliteScheduleStorage, apply_slot_op, atomic_write, file_signature
+from filewatch import FileWatcher
+from update_processor import UPDATE_STARTED, PerUserUpdateProcessor
+from jsonlog import ActionSampler, setup_logging
+from outbox import AdminOutbox
+from ratelimit import BACKGROUND, PriorityRateLimiter
+from metrics import Metrics
+from profiler import UpdateProfiler
+from analytics import FunnelAnalytics
+from shared import SharedState
+from persistence import SessionCodec, SessionPersistence
+from sessions import SessionTracker
+from booking import CUSTOM_OFFSET_RANGE, BookingSession, Instrument, Level, Timezone
+
+# Логирование: записи уходят в очередь, форматирование и вывод — в отдельном
+# потоке. LOG_FORMAT=json|text; LOG_SAMPLE="Start=0.1,Level=0.5" — доля
+# пользователей, чьи частые действия попадают в лог
+setup_logging(fmt=os.environ.get('LOG_FORMAT', 'json'))
+logging.getLogger('httpx').setLevel(logging.WARNING)  # строка на каждый запрос к Bot API
 logger = logging.getLogger(__name__)
+LOG_SAMPLER = ActionSampler.parse(os.environ.get('LOG_SAMPLE'))
 
 # Настройки
 TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 ADMIN_ID = 5094488507
 WELCOME_PHOTO = "https://drive.usercontent.google.com/download?id=19jsxEL17vlwXsBZ8wrNzoXP8q459nOtl&export=view"
+WELCOME_PHOTO_FILE = os.environ.get('WELCOME_PHOTO_FILE')  # локальная копия картинки (необязательно)
+WELCOME_PHOTO_ID_FILE = 'welcome_photo_id.txt'
 SCHEDULE_FILE = 'schedule.json'
+SCHEDULE_JOURNAL_FILE = 'schedule.journal'
+BOOKINGS_FILE = 'bookings.jsonl'
+SCHEDULE_ARCHIVE_FILE = 'schedule_archive.jsonl.gz'
+ARCHIVE_INTERVAL = float(os.environ.get('ARCHIVE_INTERVAL', '3600'))  # секунды между переносами в архив
+ANALYTICS_FILE = 'analytics.json'
+ANALYTICS_FLUSH_INTERVAL = float(os.environ.get('ANALYTICS_FLUSH_INTERVAL', '300'))
+SESSIONS_DB_FILE = os.environ.get('SESSIONS_DB', 'sessions.db')  # диалоги, прерванные перезапуском
+SESSION_FLUSH_INTERVAL = float(os.environ.get('SESSION_FLUSH_INTERVAL', '10'))
+# Брошенные диалоги завершаются через CONVERSATION_TIMEOUT секунд (0 — никогда),
+# сессии молчащих дольше SESSION_TTL удаляются из памяти раз в SESSION_SWEEP_INTERVAL;
+# жёсткие пределы — SESSION_MAX сессий и SESSION_MEMORY_LIMIT байт (оценка).
+# С SHARED_STATE_DB сессии живут в общей базе: память воркера — лишь кэш, а
+# брошенные диалоги сбрасываются при загрузке и удаляются из базы лидером
+CONVERSATION_TIMEOUT = float(os.environ.get('CONVERSATION_TIMEOUT', '3600'))
+SESSION_TTL = float(os.environ.get('SESSION_TTL', '86400'))
+SESSION_SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', '300'))
+SESSION_MAX = int(os.environ.get('SESSION_MAX', '50000'))
+SESSION_MEMORY_LIMIT = int(os.environ.get('SESSION_MEMORY_LIMIT', str(64 * 1024 * 1024)))
+SCHEDULE_DB_FILE = os.environ.get('SCHEDULE_DB', 'schedule.db')
+SCHEDULE_BACKEND = os.environ.get('SCHEDULE_BACKEND', 'json')  # json | sqlite
+# Правки schedule.json вручную подхватываются без перезапуска (0 — выключено);
+# без inotify файл опрашивается раз в SCHEDULE_WATCH_INTERVAL секунд
+SCHEDULE_WATCH = os.environ.get('SCHEDULE_WATCH', '1') != '0'
+SCHEDULE_WATCH_INTERVAL = float(os.environ.get('SCHEDULE_WATCH_INTERVAL', '2'))
+MAX_CONCURRENT_UPDATES = int(os.environ.get('MAX_CONCURRENT_UPDATES', '32'))
+
+# Несколько процессов бота: включается SHARED_STATE_DB (файл SQLite, общий
+# для всех процессов на одной машине). Расписание тогда хранится только в
+# SQLite, апдейты забирает один процесс-лидер, обрабатывают все (см. shared.py).
+# Аналитика, метрики и /slow — свои у каждого процесса
+SHARED_STATE_DB = os.environ.get('SHARED_STATE_DB')
+WORKER_ID = os.environ.get('WORKER_ID') or f'{socket.gethostname()}-{os.getpid()}'
+if SHARED_STATE_DB:
+    SCHEDULE_BACKEND = 'sqlite'
+    ANALYTICS_FILE = f'analytics-{WORKER_ID}.json'
+
+# Режим работы: polling (локально) или webhook (на сервере)
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')  # без него при запуске создаётся случайный
+PORT = int(os.environ.get('PORT', '8443'))
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')  # локальная замена Bot API, см. tools/fake_bot_api.py
+
+# Метрики Prometheus: включаются, если задан METRICS_PORT
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+
+# Профилирование апдейтов: каждый PROFILE_SAMPLE-й апдейт и все медленнее
+# PROFILE_SLOW_MS (0 — выключено); профили пишутся в PROFILE_DIR, см. /slow
+PROFILE_SAMPLE = int(os.environ.get('PROFILE_SAMPLE', '0'))
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', '0'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
 
 # Состояния
 LEVEL, INSTRUMENT, TIMEZONE, DAY, TIME, CUSTOM_TIMEZONE = range(6)
@@ -32,28 +112,28 @@ DEFAULT_WEEKLY_SCHEDULE = {
 }
 
 # Функции работы с расписанием
+# json:   каждое изменение дописывается в журнал, а снимок schedule.json
+#         пересобирается из памяти в фоне (сжатие журнала)
+# sqlite: изменения пишутся в schedule.db; при первом запуске данные
+#         переносятся из schedule.json
+JSON_STORAGE = JsonScheduleStorage(SCHEDULE_FILE, SCHEDULE_JOURNAL_FILE, lambda: SCHEDULE,
+                                   compact_delay=float(os.environ.get('SCHEDULE_COMPACT_DELAY', '30')),
+                                   bookings_path=BOOKINGS_FILE)
+SCHEDULE_STORAGE = SqliteScheduleStorage(SCHEDULE_DB_FILE) if SCHEDULE_BACKEND == 'sqlite' else JSON_STORAGE
+
 def load_schedule():
-    try:
-        with open(SCHEDULE_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {'weekly_blocked': DEFAULT_WEEKLY_SCHEDULE.copy(), 'specific_dates': {}}
+    default = {'weekly_blocked': DEFAULT_WEEKLY_SCHEDULE.copy(), 'specific_dates': {}}
+    if SCHEDULE_STORAGE is JSON_STORAGE:
+        return JSON_STORAGE.load(default)
+    return SCHEDULE_STORAGE.load(default, migrate_from=JSON_STORAGE)
 
 def save_schedule(schedule):
-    with open(SCHEDULE_FILE, 'w', encoding='utf-8') as f:
-        json.dump(schedule, f, ensure_ascii=False, indent=2)
+    SCHEDULE_STORAGE.save(schedule)
 
 SCHEDULE = load_schedule()
 
 # Константы
-TIMEZONES = {
-    'utc3': 'UTC+3 (Москва)',
-    'utc4': 'UTC+4 (Самара)',
-    'utc5': 'UTC+5 (Екатеринбург)',
-    'utc7': 'UTC+7 (Красноярск/Новосибирск)',
-    'utc10': 'UTC+10 (Владивосток)',
-    'custom': 'Другой часовой пояс'
-}
+TIMEZONES = {tz.key: tz.label for tz in Timezone}  # ключ для callback_data -> название
 
 WEEKDAYS_RU = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
 WEEKDAYS_EN = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
@@ -122,39 +202,422 @@ NO_INSTRUMENT_TEXT = """🎸 **Отлично!**
 
 Александр напишет вам в течение 24 часов!"""
 
+# Битовый индекс занятости: один int на день недели и на конкретную дату,
+# бит i соответствует TIME_SLOTS[i]
+SLOT_BITS = {slot: 1 << i for i, slot in enumerate(TIME_SLOTS)}
+ALL_SLOTS_MASK = (1 << len(TIME_SLOTS)) - 1
+SLOT_COUNTS = [bin(mask).count('1') for mask in range(ALL_SLOTS_MASK + 1)]
+
+WEEKLY_MASKS = [0] * 7
+SPECIFIC_MASKS = {}
+BOOKED_MASKS = {}  # слоты, уже занятые учениками
+SCHEDULE_VERSION = 0  # увеличивается при каждом изменении SCHEDULE
+
+def slots_to_mask(slots):
+    mask = 0
+    for slot in slots:
+        mask |= SLOT_BITS.get(slot, 0)
+    return mask
+
+def mask_to_slots(mask):
+    return [slot for slot in TIME_SLOTS if mask & SLOT_BITS[slot]]
+
+def rebuild_schedule_index():
+    """Полностью пересобирает битовый индекс из SCHEDULE"""
+    global WEEKLY_MASKS, SPECIFIC_MASKS, SCHEDULE_VERSION
+    weekly = [0] * 7
+    for day, slots in SCHEDULE['weekly_blocked'].items():
+        if day in WEEKDAYS_EN:
+            weekly[WEEKDAYS_EN.index(day)] = slots_to_mask(slots)
+    specific = {}
+    for date_str, slots in SCHEDULE['specific_dates'].items():
+        mask = slots_to_mask(slots)
+        if mask:
+            specific[datetime.fromisoformat(date_str).date()] = mask
+    WEEKLY_MASKS, SPECIFIC_MASKS = weekly, specific
+    SCHEDULE_VERSION += 1
+
+def rebuild_booking_index(bookings):
+    global BOOKED_MASKS, SCHEDULE_VERSION
+    booked = {}
+    for booking in bookings:
+        date = datetime.fromisoformat(booking['date']).date()
+        booked[date] = booked.get(date, 0) | SLOT_BITS.get(booking['slot'], 0)
+    BOOKED_MASKS = booked
+    SCHEDULE_VERSION += 1
+
+def get_blocked_mask(date):
+    """Недоступные ученикам слоты: блокировки админа и уже занятые"""
+    return WEEKLY_MASKS[date.weekday()] | SPECIFIC_MASKS.get(date, 0) | BOOKED_MASKS.get(date, 0)
+
+def get_section_mask(section, key):
+    """Маска блокировок только одного раздела: weekly_blocked (день недели) или specific_dates (дата)"""
+    if section == 'weekly_blocked':
+        return WEEKLY_MASKS[WEEKDAYS_EN.index(key)]
+    return SPECIFIC_MASKS.get(datetime.fromisoformat(key).date(), 0)
+
+# Апдейты обрабатываются параллельно (см. PerUserUpdateProcessor), поэтому все
+# изменения SCHEDULE и индекса делаются синхронно, без await внутри: на
+# event loop такой участок не может перемешаться с другим обработчиком
+def set_slot_blocked(section, key, time_slot, blocked):
+    """Блокирует/разблокирует слот в SCHEDULE и индексе. Возвращает True, если что-то изменилось"""
+    global SCHEDULE_VERSION
+    if not apply_slot_op(SCHEDULE, section, key, time_slot, blocked):
+        return False
+    mask = slots_to_mask(SCHEDULE[section].get(key, []))
+    if section == 'weekly_blocked':
+        WEEKLY_MASKS[WEEKDAYS_EN.index(key)] = mask
+    else:
+        date = datetime.fromisoformat(key).date()
+        if mask:
+            SPECIFIC_MASKS[date] = mask
+        else:
+            SPECIFIC_MASKS.pop(date, None)
+    SCHEDULE_VERSION += 1
+    SCHEDULE_STORAGE.record(section, key, time_slot, blocked)
+    return True
+
+def toggle_slot(section, key, time_slot):
+    """Переключает слот. Возвращает True, если слот теперь заблокирован"""
+    blocked = not get_section_mask(section, key) & SLOT_BITS[time_slot]
+    set_slot_blocked(section, key, time_slot, blocked)
+    return blocked
+
+async def claim_slot(date, time_slot, booking):
+    """Атомарно занимает слот за учеником. False, если слот уже занят или заблокирован.
+    Между проверкой и записью в память нет await, поэтому два параллельных апдейта
+    не займут один слот. В режиме нескольких процессов окончательно решает база:
+    слот мог занять другой процесс, этого в памяти ещё не видно"""
+    global SCHEDULE_VERSION
+    bit = SLOT_BITS.get(time_slot)
+    if bit is None or get_blocked_mask(date) & bit:
+        return False
+    BOOKED_MASKS[date] = BOOKED_MASKS.get(date, 0) | bit
+    SCHEDULE_VERSION += 1
+    booking = dict(booking, date=date.isoformat(), slot=time_slot)
+    if SHARED is None:
+        SCHEDULE_STORAGE.record_booking(booking)
+        return True
+    # Если не вышло, бит остаётся: слот действительно занят
+    return await SCHEDULE_STORAGE.claim_booking(booking)
+
+async def reload_schedule():
+    """Перечитывает расписание и записи из базы, когда их изменил другой процесс"""
+    schedule, bookings = await SCHEDULE_STORAGE.reload(since=datetime.now().date().isoformat())
+    SCHEDULE.clear()
+    SCHEDULE.update(schedule)
+    rebuild_schedule_index()
+    rebuild_booking_index(bookings)
+
+rebuild_schedule_index()
+rebuild_booking_index(SCHEDULE_STORAGE.load_bookings(since=datetime.now().date().isoformat()))
+
+SHARED = SharedState(SHARED_STATE_DB, WORKER_ID, SCHEDULE_STORAGE) if SHARED_STATE_DB else None
+if SHARED is not None:
+    SHARED.on_schedule_change = reload_schedule
+    SHARED.session_timeout = CONVERSATION_TIMEOUT or None
+
 # Вспомогательные функции
 def is_slot_blocked(date, time_slot):
-    date_str = date.isoformat()
-    if date_str in SCHEDULE['specific_dates'] and time_slot in SCHEDULE['specific_dates'][date_str]:
-        return True
-    weekday = WEEKDAYS_EN[date.weekday()]
-    return time_slot in SCHEDULE['weekly_blocked'].get(weekday, [])
+    return bool(get_blocked_mask(date) & SLOT_BITS[time_slot])
 
 def get_available_slots(date):
-    return [slot for slot in TIME_SLOTS if not is_slot_blocked(date, slot)]
-
-async def notify_admin(context, message):
+    return mask_to_slots(ALL_SLOTS_MASK & ~get_blocked_mask(date))
+
+def count_available_slots(date):
+    return SLOT_COUNTS[ALL_SLOTS_MASK & ~get_blocked_mask(date)]
+
+# Архив прошедших дат: specific_dates хранит только сегодняшний день и
+# будущее (админка даёт блокировать даты не дальше горизонта записи),
+# всё прошедшее периодически переносится в сжатый архив
+SCHEDULE_ARCHIVE = ScheduleArchive(SCHEDULE_ARCHIVE_FILE)
+
+def forget_past_dates(before):
+    """Убирает из SCHEDULE и индекса даты раньше before (ISO). Возвращает число удалённых дат"""
+    global SCHEDULE_VERSION
+    past = [d for d in SCHEDULE['specific_dates'] if d < before]
+    for date_str in past:
+        del SCHEDULE['specific_dates'][date_str]
+    before_date = datetime.fromisoformat(before).date()
+    for index in (SPECIFIC_MASKS, BOOKED_MASKS):
+        for date in [d for d in index if d < before_date]:
+            del index[date]
+    if past:
+        SCHEDULE_VERSION += 1
+        SCHEDULE_STORAGE.forget_dates(before)
+    return len(past)
+
+# Правка schedule.json снаружи: файл читается и проверяется в потоке,
+# затем расписание в памяти заменяется целиком синхронным участком (как в
+# reload_schedule); новая SCHEDULE_VERSION сбрасывает кэши клавиатур и
+# страниц. Свои записи снимка бот узнаёт по подписи файла
+def read_schedule_file(path):
+    """Читает и проверяет schedule.json. ValueError с описанием, если файл неверный"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or not isinstance(data.get('weekly_blocked'), dict) \
+            or not isinstance(data.get('specific_dates'), dict):
+        raise ValueError("нужны разделы weekly_blocked и specific_dates")
+    schedule = {'weekly_blocked': {day: [] for day in WEEKDAYS_EN}, 'specific_dates': {}}
+    for section, items in data.items():
+        if section not in schedule:
+            raise ValueError(f"неизвестный раздел {section}")
+        for key, slots in items.items():
+            if section == 'weekly_blocked' and key not in WEEKDAYS_EN:
+                raise ValueError(f"неизвестный день недели {key}")
+            # Только YYYY-MM-DD: ключ с временем индекс отнёс бы к той же дате, а хранил бы отдельно
+            if section == 'specific_dates' and datetime.fromisoformat(key).date().isoformat() != key:
+                raise ValueError(f"дата {key} должна быть в формате ГГГГ-ММ-ДД")
+            if not isinstance(slots, list) or any(not isinstance(slot, str) or slot not in SLOT_BITS for slot in slots):
+                raise ValueError(f"{section}.{key}: неизвестный слот в {slots}")
+            if slots or section == 'weekly_blocked':
+                schedule[section][key] = sorted(set(slots))
+    return schedule
+
+def schedule_diff(old, new):
+    """(заблокировано, разблокировано) — множества (раздел, ключ, слот)"""
+    def cells(schedule):
+        return {(section, key, slot) for section in ('weekly_blocked', 'specific_dates')
+                for key, slots in schedule[section].items() for slot in slots}
+    before, after = cells(old), cells(new)
+    return after - before, before - after
+
+async def reload_schedule_file():
+    """Вызывается FileWatcher при изменении SCHEDULE_FILE"""
+    if SHARED is not None and not SHARED.is_leader:
+        return  # остальные процессы увидят изменение в базе
+    signature = file_signature(SCHEDULE_FILE)
+    if signature is None or signature == JSON_STORAGE.written_signature:
+        return
+    try:
+        schedule = await asyncio.get_running_loop().run_in_executor(None, read_schedule_file, SCHEDULE_FILE)
+    except (OSError, ValueError) as e:
+        logger.error(f"Schedule file {SCHEDULE_FILE} was not reloaded: {e}")
+        ADMIN_OUTBOX.send(f"⚠️ *{SCHEDULE_FILE} не загружен*, действует прежнее расписание.\n`{e}`")
+        return
+    blocked, unblocked = schedule_diff(SCHEDULE, schedule)
+    if blocked or unblocked:
+        SCHEDULE.clear()
+        SCHEDULE.update(schedule)
+        rebuild_schedule_index()
+    if SCHEDULE_STORAGE is JSON_STORAGE:
+        JSON_STORAGE.adopt(signature)
+    elif blocked or unblocked:
+        await asyncio.get_running_loop().run_in_executor(None, SCHEDULE_STORAGE.save, schedule)
+    if blocked or unblocked:
+        logger.info(f"Schedule reloaded from {SCHEDULE_FILE}: {len(blocked)} slots blocked, {len(unblocked)} unblocked")
+        ADMIN_OUTBOX.send(f"♻️ Расписание перечитано из {SCHEDULE_FILE}: "
+                          f"заблокировано {len(blocked)}, разблокировано {len(unblocked)}", digest=True)
+
+SCHEDULE_WATCHER = FileWatcher(SCHEDULE_FILE, reload_schedule_file, interval=SCHEDULE_WATCH_INTERVAL)
+
+async def archive_past_dates(context: ContextTypes.DEFAULT_TYPE):
+    """Задача job queue: переносит прошедшие даты в архив"""
+    if SHARED is not None and not SHARED.is_leader:
+        return  # архив общий, им занимается лидер
+    today = datetime.now().date().isoformat()
+    past = {d: list(slots) for d, slots in SCHEDULE['specific_dates'].items() if d < today and slots}
+    if past:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, SCHEDULE_ARCHIVE.append, past)
+        except OSError as e:
+            logger.error(f"Schedule archive error: {e}")
+            return
+    # Прошедшие даты админка уже не меняет, так что за время записи архива они остались прежними
+    removed = forget_past_dates(today)
+    if removed:
+        logger.info(f"Archived {removed} past dates to {SCHEDULE_ARCHIVE_FILE}")
+
+# Приветственное фото: после первой удачной отправки Telegram возвращает
+# file_id, по которому фото отправляется мгновенно, без скачивания с Google Drive
+def load_welcome_photo_id():
     try:
-        await context.bot.send_message(chat_id=ADMIN_ID, text=message, parse_mode='Markdown')
-    except Exception as e:
-        logger.error(f"Notify error: {e}")
+        with open(WELCOME_PHOTO_ID_FILE, 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+WELCOME_PHOTO_ID = load_welcome_photo_id()
 
-def log_user_action(user, action):
-    logger.info(f"User @{user.username or 'none'} ({user.id}) - {action}")
+def read_welcome_photo_source():
+    """Байты WELCOME_PHOTO_FILE или адрес WELCOME_PHOTO (читает диск — вызывать в пуле потоков)"""
+    if WELCOME_PHOTO_FILE:
+        try:
+            with open(WELCOME_PHOTO_FILE, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Cannot read welcome photo {WELCOME_PHOTO_FILE}: {e}")
+    return WELCOME_PHOTO
+
+async def send_welcome(message):
+    global WELCOME_PHOTO_ID
+    if WELCOME_PHOTO_ID:
+        try:
+            await message.reply_photo(photo=WELCOME_PHOTO_ID, caption=WELCOME_TEXT, reply_markup=get_main_keyboard())
+            return
+        except BadRequest as e:
+            # file_id стал недействительным — загружаем фото заново
+            logger.warning(f"Welcome photo file_id rejected: {e}")
+            WELCOME_PHOTO_ID = None
+        except TelegramError as e:
+            logger.error(f"Welcome photo error: {e}")
+            await message.reply_text(WELCOME_TEXT, reply_markup=get_main_keyboard())
+            return
+    photo = await asyncio.get_running_loop().run_in_executor(None, read_welcome_photo_source)
+    try:
+        sent = await message.reply_photo(photo=photo, caption=WELCOME_TEXT, reply_markup=get_main_keyboard())
+    except TelegramError as e:
+        logger.error(f"Welcome photo upload error: {e}")
+        await message.reply_text(WELCOME_TEXT, reply_markup=get_main_keyboard())
+        return
+    if sent.photo:
+        WELCOME_PHOTO_ID = sent.photo[-1].file_id
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, atomic_write, WELCOME_PHOTO_ID_FILE, WELCOME_PHOTO_ID.encode('utf-8'))
+        except OSError as e:
+            # Не страшно: после перезапуска фото просто загрузится ещё раз
+            logger.error(f"Cannot save welcome photo file_id: {e}")
+
+# Все запросы к Bot API проходят через общий ограничитель скорости;
+# ответы пользователям важнее фоновых отправок
+RATE_LIMITER = PriorityRateLimiter(global_rate=float(os.environ.get('BOT_API_RATE', '30')),
+                                   chat_rate=float(os.environ.get('BOT_API_CHAT_RATE', '1')))
+
+# Уведомления админу идут через очередь с ограничением скорости;
+# несрочные (digest=True) собираются в периодическую сводку
+ADMIN_OUTBOX = AdminOutbox(ADMIN_ID, digest_interval=float(os.environ.get('ADMIN_DIGEST_INTERVAL', '300')),
+                           send_kwargs={'rate_limit_args': {'priority': BACKGROUND}})
+
+METRICS = Metrics()
+PROFILER = UpdateProfiler(PROFILE_DIR, PROFILE_SAMPLE, PROFILE_SLOW_MS) if PROFILE_SAMPLE or PROFILE_SLOW_MS else None
+
+async def notify_admin(context, message, digest=False):
+    ADMIN_OUTBOX.send(message, digest=digest)
+
+# Счётчики воронки для /stats: шаги и выбор пользователей, без логов
+ANALYTICS = FunnelAnalytics(ANALYTICS_FILE).load()
+
+async def flush_analytics(context: ContextTypes.DEFAULT_TYPE):
+    await ANALYTICS.flush()
+
+# Незавершённые диалоги переживают перезапуск: раз в SESSION_FLUSH_INTERVAL
+# изменившиеся состояния и user_data пишутся в SESSIONS_DB_FILE. В режиме
+# нескольких процессов сессии и так хранятся в SHARED_STATE_DB
+SESSION_CODEC = SessionCodec(
+    keys=['booking', 'block_type', 'unblock_type', 'manage_type', 'admin_date_offset',
+          'selected_day', 'selected_date', 'selected_day_unblock', 'selected_date_unblock'],
+    constants=[*WEEKDAYS_EN, 'block_weekly', 'block_specific', 'manage_weekly', 'manage_specific'],
+    records=[BookingSession],
+)
+PERSISTENCE = SessionPersistence(SESSIONS_DB_FILE, SESSION_CODEC, SESSION_FLUSH_INTERVAL) if SHARED is None else None
+
+SESSIONS = SessionTracker(SESSION_TTL, SESSION_MAX, SESSION_MEMORY_LIMIT)
+
+async def sweep_sessions(context: ContextTypes.DEFAULT_TYPE):
+    SESSIONS.sweep()
+    if SHARED is not None and SHARED.is_leader:
+        pruned = await SHARED.prune_sessions(CONVERSATION_TIMEOUT or SESSION_TTL)
+        if pruned:
+            logger.info(f"Pruned {pruned} abandoned shared sessions")
+
+def log_user_action(user, action, state=None):
+    if not LOG_SAMPLER.keep(action.split(':', 1)[0], user.id):
+        return
+    started = UPDATE_STARTED.get()
+    latency_ms = round((time.perf_counter() - started) * 1000, 1) if started is not None else None
+    # Сообщение собирается из аргументов уже в потоке логирования
+    logger.info("User @%s (%s) - %s", user.username or 'none', user.id, action,
+                extra={'user_id': user.id, 'username': user.username, 'action': action, 'state': state,
+                       'latency_ms': latency_ms})
 
 def get_available_dates(offset=0):
     dates = []
-    start_date = datetime.now().date() + timedelta(days=offset)
+    today = datetime.now().date()
+    start_date = today + timedelta(days=offset)
     for i in range(7):
         date = start_date + timedelta(days=i)
-        if (date - datetime.now().date()).days <= 14 and get_available_slots(date):
+        if (date - today).days <= 14 and get_blocked_mask(date) != ALL_SLOTS_MASK:
             dates.append(date)
     return dates
 
 def format_date(date):
     return f"{WEEKDAYS_RU[date.weekday()]} {date.day} {MONTHS_RU[date.month - 1]}"
 
+def get_booking_session(context):
+    """Ответы пользователя в воронке записи (создаются при входе в воронку)"""
+    session = context.user_data.get('booking')
+    if session is None:
+        session = context.user_data['booking'] = BookingSession()
+    return session
+
+def start_funnel_attempt(context, restart=False):
+    """BookingSession для /start и входа в запись. Попытка записи продолжается,
+    пока не подана заявка: повторные /start и «Записаться» не считаются в воронке
+    заново. restart — очистить ответы, сохранив пройденные шаги"""
+    previous = context.user_data.get('booking')
+    if previous is not None and not previous.has_reached('booked'):
+        if not restart:
+            return previous
+        session = BookingSession(reached=previous.reached)
+    else:
+        session = BookingSession()
+    context.user_data['booking'] = session
+    return session
+
+def track_step(session, step, **dimensions):
+    """Шаг воронки считается один раз за попытку записи (возвраты «назад» и повторный выбор — нет)"""
+    if session.reach(step):
+        ANALYTICS.track(step, **dimensions)
+
+# Кэш клавиатур
+KEYBOARD_CACHE_SIZE = 256
+
+class KeyboardCache:
+    """LRU-кэш готовых InlineKeyboardMarkup со счётчиками попаданий"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, key, build):
+        markup = self.data.get(key)
+        if markup is not None:
+            self.hits += 1
+            self.data.move_to_end(key)
+            return markup
+        self.misses += 1
+        markup = self.data[key] = build()
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+        return markup
+
+    def stats(self):
+        return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses}
+
+KEYBOARD_CACHE = KeyboardCache(KEYBOARD_CACHE_SIZE)
+
+def cached_keyboard(schedule_dependent=False):
+    """Мемоизирует построитель клавиатуры. Зависящие от расписания клавиатуры
+    пересобираются при смене SCHEDULE_VERSION или текущей даты"""
+    def decorator(builder):
+        name = builder.__name__
+
+        @functools.wraps(builder)
+        def wrapper(*args):
+            if schedule_dependent:
+                key = (name, args, SCHEDULE_VERSION, datetime.now().date())
+            else:
+                key = (name, args)
+            return KEYBOARD_CACHE.get_or_build(key, lambda: builder(*args))
+        return wrapper
+    return decorator
+
 # Клавиатуры
+@cached_keyboard()
 def get_main_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🎯 Записаться на пробный урок", callback_data='trial')],
@@ -162,12 +625,14 @@ def get_main_keyboard():
         [InlineKeyboardButton("📋 Как подготовиться?", callback_data='preparation')]
     ])
 
+@cached_keyboard()
 def get_trial_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📅 Записаться прямо сейчас", callback_data='start_booking')],
         [InlineKeyboardButton("⬅️ Вернуться в меню", callback_data='back_to_main')]
     ])
 
+@cached_keyboard()
 def get_level_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🆕 Я новичок", callback_data='level_beginner')],
@@ -175,6 +640,7 @@ def get_level_keyboard():
         [InlineKeyboardButton("⬅️ Назад", callback_data='trial')]
     ])
 
+@cached_keyboard()
 def get_instrument_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🎸 Электрогитара", callback_data='inst_electric')],
@@ -183,16 +649,18 @@ def get_instrument_keyboard():
         [InlineKeyboardButton("⬅️ Назад", callback_data='back_to_level')]
     ])
 
+@cached_keyboard()
 def get_timezone_keyboard():
     keyboard = [[InlineKeyboardButton(v, callback_data=f'tz_{k}')] for k, v in TIMEZONES.items()]
     keyboard.append([InlineKeyboardButton("⬅️ Отмена", callback_data='back_to_main')])
     return InlineKeyboardMarkup(keyboard)
 
+@cached_keyboard(schedule_dependent=True)
 def get_days_keyboard(offset=0):
     dates = get_available_dates(offset)
     keyboard = []
     for date in dates:
-        count = len(get_available_slots(date))
+        count = count_available_slots(date)
         keyboard.append([InlineKeyboardButton(f"{format_date(date)} ({count} слотов)", callback_data=f'date_{date.isoformat()}')])
     nav = []
     if offset > 0:
@@ -204,6 +672,7 @@ def get_days_keyboard(offset=0):
     keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data='back_to_timezone')])
     return InlineKeyboardMarkup(keyboard)
 
+@cached_keyboard(schedule_dependent=True)
 def get_time_keyboard(date):
     slots = get_available_slots(date)
     keyboard = []
@@ -216,43 +685,62 @@ def get_time_keyboard(date):
     return InlineKeyboardMarkup(keyboard)
 
 # Обработчики команд
+# Навигация по кнопкам: в режиме edit (по умолчанию) следующий экран
+# заменяет текущее сообщение, а не добавляется новым. В чате не копятся
+# устаревшие клавиатуры, а правки не тратят лимит сообщений в чат.
+# Фото с подписью в текст не превращается, в этом случае (и при любой
+# ошибке правки) сообщение отправляется заново. NAV_MODE=send — старое поведение
+NAV_MODE = os.environ.get('NAV_MODE', 'edit')  # edit | send
+
+async def show(query, text, parse_mode=None, reply_markup=None, force_edit=False):
+    """Показывает следующий экран в ответ на нажатие кнопки"""
+    message = query.message
+    if (NAV_MODE == 'edit' or force_edit) and getattr(message, 'text', None) is not None:
+        try:
+            await query.edit_message_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+            return
+        except BadRequest as e:
+            if 'not modified' in str(e):
+                return  # повторное нажатие той же кнопки
+            logger.warning(f"Edit failed, sending a new message: {e}")
+    await message.reply_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     log_user_action(user, "Start")
-    await notify_admin(context, f"🆕 *Новый пользователь!*\n👤 {user.first_name}\n🔗 @{user.username or 'нет'}\n🆔 `{user.id}`")
-    try:
-        await update.message.reply_photo(photo=WELCOME_PHOTO, caption=WELCOME_TEXT, reply_markup=get_main_keyboard())
-    except:
-        await update.message.reply_text(WELCOME_TEXT, reply_markup=get_main_keyboard())
+    track_step(start_funnel_attempt(context), 'start')
+    await notify_admin(context, f"🆕 *Новый пользователь!*\n👤 {user.first_name}\n🔗 @{user.username or 'нет'}\n🆔 `{user.id}`", digest=True)
+    await send_welcome(update.message)
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     if query.data == 'trial':
-        await query.message.reply_text(TRIAL_TEXT, parse_mode='Markdown', reply_markup=get_trial_keyboard())
+        await show(query, TRIAL_TEXT, parse_mode='Markdown', reply_markup=get_trial_keyboard())
     elif query.data == 'about':
-        await query.message.reply_text(ABOUT_TEXT, parse_mode='Markdown', reply_markup=get_trial_keyboard())
+        await show(query, ABOUT_TEXT, parse_mode='Markdown', reply_markup=get_trial_keyboard())
     elif query.data == 'preparation':
-        await query.message.reply_text(PREPARATION_TEXT, parse_mode='Markdown', reply_markup=get_trial_keyboard())
+        await show(query, PREPARATION_TEXT, parse_mode='Markdown', reply_markup=get_trial_keyboard())
     elif query.data == 'start_booking':
-        log_user_action(query.from_user, "Booking")
-        await query.message.reply_text("**Вы новичок или уже имеете опыт?**", parse_mode='Markdown', reply_markup=get_level_keyboard())
+        session = start_funnel_attempt(context, restart=True)
+        log_user_action(query.from_user, "Booking", state='entry')
+        track_step(session, 'booking')
+        await show(query, "**Вы новичок или уже имеете опыт?**", parse_mode='Markdown', reply_markup=get_level_keyboard())
         return LEVEL
     elif query.data == 'back_to_main':
-        try:
-            await query.message.reply_photo(photo=WELCOME_PHOTO, caption=WELCOME_TEXT, reply_markup=get_main_keyboard())
-        except:
-            await query.message.reply_text(WELCOME_TEXT, reply_markup=get_main_keyboard())
+        await send_welcome(query.message)
         return ConversationHandler.END
 
 async def level_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    level = "Новичок" if query.data == 'level_beginner' else "С опытом"
-    context.user_data['level'] = level
-    log_user_action(query.from_user, f"Level: {level}")
-    await query.message.reply_text("**Какой у вас инструмент?**", parse_mode='Markdown', reply_markup=get_instrument_keyboard())
+    session = get_booking_session(context)
+    session.level = Level.BEGINNER if query.data == 'level_beginner' else Level.EXPERIENCED
+    level = session.level_label
+    log_user_action(query.from_user, f"Level: {level}", state='level')
+    track_step(session, 'level', level=level)
+    await show(query, "**Какой у вас инструмент?**", parse_mode='Markdown', reply_markup=get_instrument_keyboard())
     return INSTRUMENT
 
 async def instrument_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -261,15 +749,18 @@ async def instrument_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user = query.from_user
     
     if query.data == 'inst_none':
-        log_user_action(user, "No instrument")
-        await query.message.reply_text(NO_INSTRUMENT_TEXT, parse_mode='Markdown', reply_markup=get_main_keyboard())
+        log_user_action(user, "No instrument", state='instrument')
+        track_step(get_booking_session(context), 'no_instrument')
+        await show(query, NO_INSTRUMENT_TEXT, parse_mode='Markdown', reply_markup=get_main_keyboard())
         await notify_admin(context, f"⚠️ *Клиент без инструмента!*\n👤 {user.first_name}\n🔗 @{user.username or 'нет'}")
         return ConversationHandler.END
     
-    inst = "Электрогитара" if query.data == 'inst_electric' else "Акустика/Классика"
-    context.user_data['instrument'] = inst
-    log_user_action(user, f"Instrument: {inst}")
-    await query.message.reply_text("🌍 **Выберите ваш часовой пояс:**", parse_mode='Markdown', reply_markup=get_timezone_keyboard())
+    session = get_booking_session(context)
+    session.instrument = Instrument.ELECTRIC if query.data == 'inst_electric' else Instrument.ACOUSTIC
+    inst = session.instrument_label
+    log_user_action(user, f"Instrument: {inst}", state='instrument')
+    track_step(session, 'instrument', instrument=inst)
+    await show(query, "🌍 **Выберите ваш часовой пояс:**", parse_mode='Markdown', reply_markup=get_timezone_keyboard())
     return TIMEZONE
 
 async def timezone_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -277,21 +768,24 @@ async def timezone_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     if query.data == 'tz_custom':
-        await query.message.reply_text("🕐 Напишите в формате: `+3` или `-2`", parse_mode='Markdown')
+        await show(query, "🕐 Напишите в формате: `+3` или `-2`", parse_mode='Markdown')
         return CUSTOM_TIMEZONE
     
-    tz_key = query.data.replace('tz_', '')
-    context.user_data['timezone'] = TIMEZONES[tz_key]
-    context.user_data['date_offset'] = 0
-    await query.message.reply_text(f"✅ Часовой пояс: **{TIMEZONES[tz_key]}**\n\n📅 **Выберите день:**", parse_mode='Markdown', reply_markup=get_days_keyboard(0))
+    session = get_booking_session(context)
+    session.set_timezone(Timezone.from_key(query.data.replace('tz_', '')))
+    track_step(session, 'timezone', timezone=session.timezone_label)
+    await show(query, f"✅ Часовой пояс: **{session.timezone_label}**\n\n📅 **Выберите день:**", parse_mode='Markdown', reply_markup=get_days_keyboard(0))
     return DAY
 
 async def custom_timezone_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         offset = int(update.message.text.strip())
-        tz = f"UTC{'+' if offset >= 0 else ''}{offset + 3} (Москва{'+' if offset >= 0 else ''}{offset})"
-        context.user_data['timezone'] = tz
-        context.user_data['date_offset'] = 0
+        if offset not in CUSTOM_OFFSET_RANGE:
+            raise ValueError(offset)
+        session = get_booking_session(context)
+        session.set_timezone(Timezone.CUSTOM, offset)
+        tz = session.timezone_label
+        track_step(session, 'timezone', timezone=tz)
         await update.message.reply_text(f"✅ Часовой пояс: **{tz}**\n\n📅 **Выберите день:**", parse_mode='Markdown', reply_markup=get_days_keyboard(0))
         return DAY
     except:
@@ -305,52 +799,84 @@ async def day_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if query.data.startswith('dates_prev_') or query.data.startswith('dates_next_'):
         offset = int(query.data.split('_')[2])
         new_offset = max(0, offset - 7) if 'prev' in query.data else min(14, offset + 7)
-        context.user_data['date_offset'] = new_offset
-        await query.edit_message_text(f"✅ Часовой пояс: **{context.user_data['timezone']}**\n\n📅 **Выберите день:**", parse_mode='Markdown', reply_markup=get_days_keyboard(new_offset))
+        get_booking_session(context).date_offset = new_offset
+        # Текст тот же, меняются только кнопки
+        await query.edit_message_reply_markup(reply_markup=get_days_keyboard(new_offset))
         return DAY
     elif query.data == 'back_to_timezone':
-        await query.message.reply_text("🌍 **Выберите ваш часовой пояс:**", parse_mode='Markdown', reply_markup=get_timezone_keyboard())
+        await show(query, "🌍 **Выберите ваш часовой пояс:**", parse_mode='Markdown', reply_markup=get_timezone_keyboard())
         return TIMEZONE
     
     date_str = query.data.replace('date_', '')
     selected_date = datetime.fromisoformat(date_str).date()
-    context.user_data['date'] = selected_date
-    context.user_data['date_formatted'] = format_date(selected_date)
-    await query.message.reply_text(f"✅ День: **{format_date(selected_date)}**\n\n🕐 **Выберите время:**", parse_mode='Markdown', reply_markup=get_time_keyboard(selected_date))
+    session = get_booking_session(context)
+    session.date = selected_date
+    track_step(session, 'day', weekday=WEEKDAYS_EN[selected_date.weekday()])
+    await show(query, f"✅ День: **{format_date(selected_date)}**\n\n🕐 **Выберите время:**", parse_mode='Markdown', reply_markup=get_time_keyboard(selected_date))
     return TIME
 
 async def time_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user = query.from_user
+    session = get_booking_session(context)
     
     if query.data == 'back_to_days':
-        offset = context.user_data.get('date_offset', 0)
-        await query.message.reply_text(f"✅ Часовой пояс: **{context.user_data['timezone']}**\n\n📅 **Выберите день:**", parse_mode='Markdown', reply_markup=get_days_keyboard(offset))
+        await show(query, f"✅ Часовой пояс: **{session.timezone_label}**\n\n📅 **Выберите день:**", parse_mode='Markdown', reply_markup=get_days_keyboard(session.date_offset))
         return DAY
     
     selected_time = query.data.replace('time_', '')
-    await query.message.reply_text(
+    selected_date = session.date
+    booking = {
+        'user_id': user.id,
+        'username': user.username,
+        'first_name': user.first_name,
+        'level': session.level_label,
+        'instrument': session.instrument_label,
+        'timezone': session.timezone_label,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+    }
+    if not await claim_slot(selected_date, selected_time, booking):
+        log_user_action(user, f"Slot taken: {selected_date} {selected_time}", state='time')
+        ANALYTICS.track('slot_taken', taken_slot=selected_time)
+        if get_available_slots(selected_date):
+            await show(query,
+                f"😔 Время **{selected_time}** только что заняли.\n\n🕐 **Выберите другое время:**",
+                parse_mode='Markdown',
+                reply_markup=get_time_keyboard(selected_date)
+            )
+            return TIME
+        await show(query,
+            f"😔 На **{format_date(selected_date)}** свободного времени не осталось.\n\n📅 **Выберите другой день:**",
+            parse_mode='Markdown',
+            reply_markup=get_days_keyboard(session.date_offset)
+        )
+        return DAY
+    
+    await show(query,
         f"✅ **Заявка принята!**\n\n"
-        f"📅 День: **{context.user_data['date_formatted']}**\n"
+        f"📅 День: **{format_date(selected_date)}**\n"
         f"🕐 Время: **{selected_time}**\n"
-        f"🌍 Часовой пояс: **{context.user_data['timezone']}**\n\n"
+        f"🌍 Часовой пояс: **{session.timezone_label}**\n\n"
         f"Александр свяжется с вами для подтверждения! 🎸",
         parse_mode='Markdown',
         reply_markup=get_main_keyboard()
     )
     
+    log_user_action(user, f"Booked: {selected_date} {selected_time}", state='time')
+    track_step(session, 'booked', slot=selected_time)
+    
     username = f"@{user.username}" if user.username else "без username"
     await notify_admin(context,
         f"🎉 *НОВАЯ ЗАЯВКА!*\n\n"
         f"👤 {user.first_name}\n"
         f"🔗 {username}\n"
         f"🆔 `{user.id}`\n\n"
-        f"📊 Уровень: {context.user_data.get('level')}\n"
-        f"🎸 Инструмент: {context.user_data.get('instrument')}\n\n"
-        f"📅 {context.user_data['date_formatted']}\n"
+        f"📊 Уровень: {session.level_label}\n"
+        f"🎸 Инструмент: {session.instrument_label}\n\n"
+        f"📅 {format_date(selected_date)}\n"
         f"🕐 {selected_time}\n"
-        f"🌍 {context.user_data['timezone']}"
+        f"🌍 {session.timezone_label}"
     )
     return ConversationHandler.END
 
@@ -516,31 +1042,15 @@ async def admin_block_time_handler(update: Update, context: ContextTypes.DEFAULT
     time_slot = query.data.replace('tsel_', '')
     
     if 'selected_day' in context.user_data:
-        weekday = context.user_data['selected_day']
-        if weekday not in SCHEDULE['weekly_blocked']:
-            SCHEDULE['weekly_blocked'][weekday] = []
-        if time_slot not in SCHEDULE['weekly_blocked'][weekday]:
-            SCHEDULE['weekly_blocked'][weekday].append(time_slot)
-            SCHEDULE['weekly_blocked'][weekday].sort()
-            save_schedule(SCHEDULE)
-            await query.answer("✅ Заблокировано!")
-        else:
-            await query.answer("⚠️ Уже заблокировано")
-        blocked = SCHEDULE['weekly_blocked'][weekday]
-        await query.edit_message_reply_markup(reply_markup=get_time_select_keyboard(blocked))
+        section, key = 'weekly_blocked', context.user_data['selected_day']
     else:
-        date_str = context.user_data['selected_date']
-        if date_str not in SCHEDULE['specific_dates']:
-            SCHEDULE['specific_dates'][date_str] = []
-        if time_slot not in SCHEDULE['specific_dates'][date_str]:
-            SCHEDULE['specific_dates'][date_str].append(time_slot)
-            SCHEDULE['specific_dates'][date_str].sort()
-            save_schedule(SCHEDULE)
-            await query.answer("✅ Заблокировано!")
-        else:
-            await query.answer("⚠️ Уже заблокировано")
-        blocked = SCHEDULE['specific_dates'][date_str]
-        await query.edit_message_reply_markup(reply_markup=get_time_select_keyboard(blocked))
+        section, key = 'specific_dates', context.user_data['selected_date']
+    if set_slot_blocked(section, key, time_slot, True):
+        await query.answer("✅ Заблокировано!")
+    else:
+        await query.answer("⚠️ Уже заблокировано")
+    blocked = SCHEDULE[section].get(key, [])
+    await query.edit_message_reply_markup(reply_markup=get_time_select_keyboard(blocked))
     return ADMIN_BLOCK_TIME
 
 async def admin_unblock_type_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -607,39 +1117,20 @@ async def admin_unblock_time_handler(update: Update, context: ContextTypes.DEFAU
     time_slot = query.data.replace('tsel_', '')
     
     if 'selected_day_unblock' in context.user_data:
-        weekday = context.user_data['selected_day_unblock']
-        if weekday in SCHEDULE['weekly_blocked'] and time_slot in SCHEDULE['weekly_blocked'][weekday]:
-            SCHEDULE['weekly_blocked'][weekday].remove(time_slot)
-            if not SCHEDULE['weekly_blocked'][weekday]:
-                del SCHEDULE['weekly_blocked'][weekday]
-            save_schedule(SCHEDULE)
-            await query.answer("✅ Разблокировано!")
-        else:
-            await query.answer("⚠️ Не было заблокировано")
-        
-        blocked = SCHEDULE['weekly_blocked'].get(weekday, [])
-        if blocked:
-            await query.edit_message_reply_markup(reply_markup=get_time_select_keyboard(blocked))
-        else:
-            await query.message.reply_text("✅ Все слоты разблокированы", reply_markup=get_admin_keyboard())
-            return ADMIN_MENU
+        section, key = 'weekly_blocked', context.user_data['selected_day_unblock']
     else:
-        date_str = context.user_data['selected_date_unblock']
-        if date_str in SCHEDULE['specific_dates'] and time_slot in SCHEDULE['specific_dates'][date_str]:
-            SCHEDULE['specific_dates'][date_str].remove(time_slot)
-            if not SCHEDULE['specific_dates'][date_str]:
-                del SCHEDULE['specific_dates'][date_str]
-            save_schedule(SCHEDULE)
-            await query.answer("✅ Разблокировано!")
-        else:
-            await query.answer("⚠️ Не было заблокировано")
-        
-        blocked = SCHEDULE['specific_dates'].get(date_str, [])
-        if blocked:
-            await query.edit_message_reply_markup(reply_markup=get_time_select_keyboard(blocked))
-        else:
-            await query.message.reply_text("✅ Все слоты разблокированы", reply_markup=get_admin_keyboard())
-            return ADMIN_MENU
+        section, key = 'specific_dates', context.user_data['selected_date_unblock']
+    if set_slot_blocked(section, key, time_slot, False):
+        await query.answer("✅ Разблокировано!")
+    else:
+        await query.answer("⚠️ Не было заблокировано")
+    
+    blocked = SCHEDULE[section].get(key, [])
+    if blocked:
+        await query.edit_message_reply_markup(reply_markup=get_time_select_keyboard(blocked))
+    else:
+        await query.message.reply_text("✅ Все слоты разблокированы", reply_markup=get_admin_keyboard())
+        return ADMIN_MENU
     return ADMIN_UNBLOCK_TIME
 
 # ====================================
@@ -648,6 +1139,7 @@ async def admin_unblock_time_handler(update: Update, context: ContextTypes.DEFAU
 # ====================================
 # АДМИН-ПАНЕЛЬ - КЛАВИАТУРЫ (УЛУЧШЕННАЯ ВЕРСИЯ)
 # ====================================
+@cached_keyboard()
 def get_admin_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📅 Просмотр расписания", callback_data='admin_view')],
@@ -655,6 +1147,7 @@ def get_admin_keyboard():
         [InlineKeyboardButton("❌ Закрыть", callback_data='admin_close')]
     ])
 
+@cached_keyboard()
 def get_manage_type_keyboard():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📆 Постоянно (каждую неделю)", callback_data='manage_weekly')],
@@ -662,11 +1155,13 @@ def get_manage_type_keyboard():
         [InlineKeyboardButton("⬅️ Назад", callback_data='admin_back')]
     ])
 
+@cached_keyboard()
 def get_weekday_keyboard():
     keyboard = [[InlineKeyboardButton(day, callback_data=f'wday_{WEEKDAYS_EN[i]}')] for i, day in enumerate(WEEKDAYS_RU)]
     keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data='admin_back')])
     return InlineKeyboardMarkup(keyboard)
 
+@cached_keyboard(schedule_dependent=True)
 def get_days_keyboard_admin(offset=0):
     dates = get_available_dates(offset)
     keyboard = []
@@ -682,20 +1177,21 @@ def get_days_keyboard_admin(offset=0):
     keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data='admin_back')])
     return InlineKeyboardMarkup(keyboard)
 
-def get_time_toggle_keyboard(blocked_times=None):
+@cached_keyboard()
+def get_time_toggle_keyboard(blocked_mask=0):
     """Клавиатура с переключением блок/разблок одной кнопкой"""
     keyboard = []
     for i in range(0, len(TIME_SLOTS), 2):
         row = []
         slot1 = TIME_SLOTS[i]
-        is_blocked1 = blocked_times and slot1 in blocked_times
+        is_blocked1 = blocked_mask & SLOT_BITS[slot1]
         row.append(InlineKeyboardButton(
             f"{'🚫' if is_blocked1 else '✅'} {slot1}",
             callback_data=f'toggle_{slot1}'
         ))
         if i + 1 < len(TIME_SLOTS):
             slot2 = TIME_SLOTS[i + 1]
-            is_blocked2 = blocked_times and slot2 in blocked_times
+            is_blocked2 = blocked_mask & SLOT_BITS[slot2]
             row.append(InlineKeyboardButton(
                 f"{'🚫' if is_blocked2 else '✅'} {slot2}",
                 callback_data=f'toggle_{slot2}'
@@ -708,6 +1204,65 @@ def get_time_toggle_keyboard(blocked_times=None):
 # ====================================
 # АДМИН-ПАНЕЛЬ - ОБРАБОТЧИКИ (УЛУЧШЕННАЯ ВЕРСИЯ)
 # ====================================
+# Просмотр расписания: блоки текста собираются один раз на версию расписания
+# и делятся на страницы по границам блоков (лимит сообщения Telegram — 4096
+# символов); текст страницы склеивается, только когда её открывают
+SCHEDULE_PAGE_LIMIT = 3900
+
+@functools.lru_cache(maxsize=1)
+def build_schedule_view(version):
+    """Блоки текста и границы страниц [(начало, конец), ...] для версии расписания"""
+    blocks = ["**Постоянно заблокировано:**"]
+    for day in WEEKDAYS_EN:
+        slots = SCHEDULE['weekly_blocked'].get(day)
+        if slots:
+            blocks.append(f"**{WEEKDAYS_RU[WEEKDAYS_EN.index(day)]}:**\n" + "\n".join(f"• {s}" for s in slots))
+    specific = [(d, slots) for d, slots in sorted(SCHEDULE['specific_dates'].items()) if slots]
+    if specific:
+        blocks.append("**Конкретные даты:**")
+        for date_str, slots in specific:
+            date = datetime.fromisoformat(date_str).date()
+            blocks.append(f"**{format_date(date)}:**\n" + "\n".join(f"• {s}" for s in slots))
+    if len(blocks) == 1:
+        blocks.append("Нет заблокированных слотов")
+    
+    pages, start, size = [], 0, 0
+    for i, block in enumerate(blocks):
+        if size + len(block) > SCHEDULE_PAGE_LIMIT and i > start:
+            pages.append((start, i))
+            start, size = i, 0
+        size += len(block) + 2
+    pages.append((start, len(blocks)))
+    return blocks, pages
+
+@functools.lru_cache(maxsize=64)
+def render_schedule_page(version, page):
+    blocks, pages = build_schedule_view(version)
+    start, end = pages[page]
+    title = "📅 **ТЕКУЩЕЕ РАСПИСАНИЕ**"
+    if len(pages) > 1:
+        title += f" (стр. {page + 1}/{len(pages)})"
+    return title + "\n\n" + "\n\n".join(blocks[start:end])
+
+def get_schedule_view(page=0):
+    """(текст страницы, номер страницы, число страниц) для текущего расписания"""
+    _, pages = build_schedule_view(SCHEDULE_VERSION)
+    page = min(max(page, 0), len(pages) - 1)
+    return render_schedule_page(SCHEDULE_VERSION, page), page, len(pages)
+
+@cached_keyboard()
+def get_schedule_view_keyboard(page, pages):
+    keyboard = []
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ Раньше", callback_data=f'aview_{page - 1}'))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton("Позже ➡️", callback_data=f'aview_{page + 1}'))
+    if nav:
+        keyboard.append(nav)
+    keyboard.extend(get_admin_keyboard().inline_keyboard)
+    return InlineKeyboardMarkup(keyboard)
+
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("❌ Нет доступа")
@@ -724,31 +1279,17 @@ async def admin_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ConversationHandler.END
     
     elif query.data == 'admin_view':
-        text = "📅 **ТЕКУЩЕЕ РАСПИСАНИЕ**\n\n**Постоянно заблокировано:**\n"
-        has_content = False
-        
-        for day, slots in SCHEDULE['weekly_blocked'].items():
-            if slots:
-                has_content = True
-                day_ru = WEEKDAYS_RU[WEEKDAYS_EN.index(day)]
-                text += f"\n**{day_ru}:**\n" + "\n".join(f"• {s}" for s in slots)
-        
-        if SCHEDULE['specific_dates']:
-            has_content = True
-            text += "\n\n**Конкретные даты:**\n"
-            for date_str, slots in sorted(SCHEDULE['specific_dates'].items()):
-                if slots:
-                    date = datetime.fromisoformat(date_str).date()
-                    text += f"\n**{format_date(date)}:**\n" + "\n".join(f"• {s}" for s in slots)
-        
-        if not has_content:
-            text += "\n\nНет заблокированных слотов"
-        
-        await query.message.reply_text(text, parse_mode='Markdown', reply_markup=get_admin_keyboard())
+        text, page, pages = get_schedule_view(0)
+        await show(query, text, parse_mode='Markdown', reply_markup=get_schedule_view_keyboard(page, pages))
+        return ADMIN_MENU
+    
+    elif query.data.startswith('aview_'):
+        text, page, pages = get_schedule_view(int(query.data.replace('aview_', '')))
+        await show(query, text, parse_mode='Markdown', reply_markup=get_schedule_view_keyboard(page, pages), force_edit=True)
         return ADMIN_MENU
     
     elif query.data == 'admin_manage':
-        await query.message.reply_text("**Выберите тип управления:**", parse_mode='Markdown', reply_markup=get_manage_type_keyboard())
+        await show(query, "**Выберите тип управления:**", parse_mode='Markdown', reply_markup=get_manage_type_keyboard())
         return ADMIN_BLOCK_TYPE
 
 async def admin_manage_type_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -756,16 +1297,16 @@ async def admin_manage_type_handler(update: Update, context: ContextTypes.DEFAUL
     await query.answer()
     
     if query.data == 'admin_back':
-        await query.message.reply_text("🔧 **АДМИН-ПАНЕЛЬ**", parse_mode='Markdown', reply_markup=get_admin_keyboard())
+        await show(query, "🔧 **АДМИН-ПАНЕЛЬ**", parse_mode='Markdown', reply_markup=get_admin_keyboard())
         return ADMIN_MENU
     
     context.user_data['manage_type'] = query.data
     
     if query.data == 'manage_weekly':
-        await query.message.reply_text("**Выберите день недели:**", parse_mode='Markdown', reply_markup=get_weekday_keyboard())
+        await show(query, "**Выберите день недели:**", parse_mode='Markdown', reply_markup=get_weekday_keyboard())
     else:
         context.user_data['admin_date_offset'] = 0
-        await query.message.reply_text("**Выберите дату:**", parse_mode='Markdown', reply_markup=get_days_keyboard_admin(0))
+        await show(query, "**Выберите дату:**", parse_mode='Markdown', reply_markup=get_days_keyboard_admin(0))
     
     return ADMIN_BLOCK_DAY
 
@@ -774,7 +1315,7 @@ async def admin_manage_day_handler(update: Update, context: ContextTypes.DEFAULT
     await query.answer()
     
     if query.data == 'admin_back':
-        await query.message.reply_text("**Выберите тип управления:**", parse_mode='Markdown', reply_markup=get_manage_type_keyboard())
+        await show(query, "**Выберите тип управления:**", parse_mode='Markdown', reply_markup=get_manage_type_keyboard())
         return ADMIN_BLOCK_TYPE
     
     if query.data.startswith('adates_prev_') or query.data.startswith('adates_next_'):
@@ -788,9 +1329,9 @@ async def admin_manage_day_handler(update: Update, context: ContextTypes.DEFAULT
         weekday = query.data.replace('wday_', '')
         context.user_data['selected_day'] = weekday
         context.user_data.pop('selected_date', None)  # Очищаем дату если была
-        blocked = SCHEDULE['weekly_blocked'].get(weekday, [])
+        blocked = get_section_mask('weekly_blocked', weekday)
         day_ru = WEEKDAYS_RU[WEEKDAYS_EN.index(weekday)]
-        await query.message.reply_text(
+        await show(query,
             f"**Управление временем: {day_ru}**\n\n"
             "🚫 - Заблокировано\n"
             "✅ - Свободно\n\n"
@@ -802,9 +1343,9 @@ async def admin_manage_day_handler(update: Update, context: ContextTypes.DEFAULT
         date_str = query.data.replace('adate_', '')
         context.user_data['selected_date'] = date_str
         context.user_data.pop('selected_day', None)  # Очищаем день если был
-        blocked = SCHEDULE['specific_dates'].get(date_str, [])
+        blocked = get_section_mask('specific_dates', date_str)
         date = datetime.fromisoformat(date_str).date()
-        await query.message.reply_text(
+        await show(query,
             f"**Управление временем: {format_date(date)}**\n\n"
             "🚫 - Заблокировано\n"
             "✅ - Свободно\n\n"
@@ -821,71 +1362,227 @@ async def admin_toggle_time_handler(update: Update, context: ContextTypes.DEFAUL
     if query.data == 'admin_back':
         await query.answer()
         if context.user_data.get('manage_type') == 'manage_weekly':
-            await query.message.reply_text("**Выберите день недели:**", parse_mode='Markdown', reply_markup=get_weekday_keyboard())
+            await show(query, "**Выберите день недели:**", parse_mode='Markdown', reply_markup=get_weekday_keyboard())
         else:
             offset = context.user_data.get('admin_date_offset', 0)
-            await query.message.reply_text("**Выберите дату:**", parse_mode='Markdown', reply_markup=get_days_keyboard_admin(offset))
+            await show(query, "**Выберите дату:**", parse_mode='Markdown', reply_markup=get_days_keyboard_admin(offset))
         return ADMIN_BLOCK_DAY
     
     if query.data == 'admin_done':
         await query.answer("✅ Изменения сохранены!")
-        await query.message.reply_text("🔧 **АДМИН-ПАНЕЛЬ**", parse_mode='Markdown', reply_markup=get_admin_keyboard())
+        await show(query, "🔧 **АДМИН-ПАНЕЛЬ**", parse_mode='Markdown', reply_markup=get_admin_keyboard())
         return ADMIN_MENU
     
     # Переключение состояния времени
     time_slot = query.data.replace('toggle_', '')
     
     if 'selected_day' in context.user_data:
-        weekday = context.user_data['selected_day']
-        if weekday not in SCHEDULE['weekly_blocked']:
-            SCHEDULE['weekly_blocked'][weekday] = []
-        
-        if time_slot in SCHEDULE['weekly_blocked'][weekday]:
-            # Разблокировать
-            SCHEDULE['weekly_blocked'][weekday].remove(time_slot)
-            if not SCHEDULE['weekly_blocked'][weekday]:
-                del SCHEDULE['weekly_blocked'][weekday]
-            save_schedule(SCHEDULE)
-            await query.answer("✅ Разблокировано!")
-        else:
-            # Заблокировать
-            SCHEDULE['weekly_blocked'][weekday].append(time_slot)
-            SCHEDULE['weekly_blocked'][weekday].sort()
-            save_schedule(SCHEDULE)
-            await query.answer("🚫 Заблокировано!")
-        
-        blocked = SCHEDULE['weekly_blocked'].get(weekday, [])
-        await query.edit_message_reply_markup(reply_markup=get_time_toggle_keyboard(blocked))
+        section, key = 'weekly_blocked', context.user_data['selected_day']
+    else:
+        section, key = 'specific_dates', context.user_data['selected_date']
     
+    if toggle_slot(section, key, time_slot):
+        await query.answer("🚫 Заблокировано!")
     else:
-        date_str = context.user_data['selected_date']
-        if date_str not in SCHEDULE['specific_dates']:
-            SCHEDULE['specific_dates'][date_str] = []
-        
-        if time_slot in SCHEDULE['specific_dates'][date_str]:
-            # Разблокировать
-            SCHEDULE['specific_dates'][date_str].remove(time_slot)
-            if not SCHEDULE['specific_dates'][date_str]:
-                del SCHEDULE['specific_dates'][date_str]
-            save_schedule(SCHEDULE)
-            await query.answer("✅ Разблокировано!")
-        else:
-            # Заблокировать
-            SCHEDULE['specific_dates'][date_str].append(time_slot)
-            SCHEDULE['specific_dates'][date_str].sort()
-            save_schedule(SCHEDULE)
-            await query.answer("🚫 Заблокировано!")
-        
-        blocked = SCHEDULE['specific_dates'].get(date_str, [])
-        await query.edit_message_reply_markup(reply_markup=get_time_toggle_keyboard(blocked))
+        await query.answer("✅ Разблокировано!")
+    
+    await query.edit_message_reply_markup(reply_markup=get_time_toggle_keyboard(get_section_mask(section, key)))
     
     return ADMIN_BLOCK_TIME
 
+async def admin_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/history — архив блокировок за последние 30 дней, /history 2026-09 — за месяц"""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Нет доступа")
+        return
+    
+    today = datetime.now().date()
+    try:
+        if context.args:
+            month = datetime.strptime(context.args[0], '%Y-%m').date()
+            start, end = month, (month + timedelta(days=32)).replace(day=1)
+        else:
+            start, end = today - timedelta(days=30), today
+    except ValueError:
+        await update.message.reply_text("Формат: /history или /history ГГГГ-ММ")
+        return
+    
+    history = await asyncio.get_running_loop().run_in_executor(
+        None, SCHEDULE_ARCHIVE.query, start.isoformat(), end.isoformat())
+    
+    text = f"🗄 **АРХИВ БЛОКИРОВОК** ({start.strftime('%d.%m.%Y')} – {(end - timedelta(days=1)).strftime('%d.%m.%Y')})\n"
+    if not history:
+        text += "\nНет записей"
+    for i, (date_str, slots) in enumerate(history.items()):
+        line = f"\n**{format_date(datetime.fromisoformat(date_str).date())}:** {', '.join(slots)}"
+        if len(text) + len(line) > 4000:
+            text += f"\n\n…и ещё {len(history) - i} дат"
+            break
+        text += line
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+FUNNEL_STEPS = [
+    ('start', '/start'),
+    ('booking', 'Начали запись'),
+    ('level', 'Уровень'),
+    ('instrument', 'Инструмент'),
+    ('timezone', 'Часовой пояс'),
+    ('day', 'День'),
+    ('booked', 'Заявка'),
+]
+
+def render_stats():
+    """Текст /stats: воронка за 24 ч / 7 / 30 дней и популярные ответы за 30 дней.
+    Шаги воронки считаются по попыткам записи (см. track_step), «слот заняли раньше» — по событиям"""
+    periods = [ANALYTICS.last_hours(24), ANALYTICS.last_days(7), ANALYTICS.last_days(30)]
+    month = periods[2]
+    
+    def percent(part, whole):
+        return f"{part * 100 / whole:.0f}%" if whole else "—"
+    
+    lines = ["📊 **ВОРОНКА ЗАПИСИ**", "", "```", f"{'':<14}{'24ч':>6}{'7д':>6}{'30д':>6}  конв."]
+    previous = None
+    for step, title in FUNNEL_STEPS:
+        counts = [totals.get('step:' + step, 0) for totals in periods]
+        conversion = percent(month.get('step:' + step, 0), month.get('step:' + previous, 0)) if previous else ""
+        lines.append(f"{title:<14}" + "".join(f"{c:>6}" for c in counts) + f"  {conversion}")
+        previous = step
+    lines.append("```")
+    lines.append(f"Итого /start → заявка за 30 дней: **{percent(month.get('step:booked', 0), month.get('step:start', 0))}**")
+    lines.append(f"Без инструмента: {month.get('step:no_instrument', 0)}, слот заняли раньше: {month.get('step:slot_taken', 0)}")
+    lines.append(f"Сессий в памяти: {SESSIONS.resident} (~{SESSIONS.estimated_bytes // 1024} КБ), "
+                 f"удалено неактивных: {SESSIONS.evicted}")
+    cache = KEYBOARD_CACHE.stats()
+    lines.append(f"Кэш клавиатур: {cache['size']} шт., попаданий {cache['hits']}, промахов {cache['misses']}")
+    
+    for dimension, title in (('level', 'Уровень'), ('instrument', 'Инструмент'), ('timezone', 'Часовой пояс'),
+                             ('weekday', 'День недели'), ('slot', 'Время'),
+                             ('taken_slot', 'Заняли раньше')):
+        values = sorted(((key.split(':', 1)[1], count) for key, count in month.items()
+                         if key.startswith(dimension + ':')), key=lambda item: -item[1])
+        if not values:
+            continue
+        if dimension == 'weekday':
+            values = [(WEEKDAYS_RU[WEEKDAYS_EN.index(v)] if v in WEEKDAYS_EN else v, c) for v, c in values]
+        lines.append(f"\n**{title}:** " + ", ".join(f"{v} — {c}" for v, c in values[:5]))
+    return "\n".join(lines)
+
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats — конверсия воронки из накопленных счётчиков"""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Нет доступа")
+        return
+    await update.message.reply_text(render_stats(), parse_mode='Markdown')
+
+async def admin_slow(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/slow — самые медленные из последних обработанных апдейтов"""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Нет доступа")
+        return
+    if PROFILER is None:
+        await update.message.reply_text("Профилирование выключено (PROFILE_SAMPLE / PROFILE_SLOW_MS)")
+        return
+    
+    text = f"🐢 **Медленные апдейты** (из последних {len(PROFILER.recent)})\n"
+    for record in PROFILER.slowest(10):
+        text += (f"\n`{record['duration_ms']:.0f} мс` (loop {record['busy_ms']:.0f} мс) {record['time'][11:]} "
+                 f"{record['type']} `{record['data'] or '-'}`")
+        if record['profile']:
+            text += f"\n📄 `{record['profile']}`"
+    await update.message.reply_text(text, parse_mode='Markdown')
+
 # ====================================
 # ГЛАВНАЯ ФУНКЦИЯ - С УЛУЧШЕННОЙ АДМИНКОЙ
 # ====================================
+STATE_NAMES = {
+    LEVEL: 'level', INSTRUMENT: 'instrument', TIMEZONE: 'timezone', DAY: 'day', TIME: 'time',
+    CUSTOM_TIMEZONE: 'custom_timezone', ADMIN_MENU: 'admin_menu', ADMIN_BLOCK_TYPE: 'admin_type',
+    ADMIN_BLOCK_DAY: 'admin_day', ADMIN_BLOCK_TIME: 'admin_time',
+}
+
+def setup_metrics(application):
+    """Оборачивает обработчики и запросы к Bot API замерами (вызывается после регистрации обработчиков)"""
+    METRICS.instrument(application, STATE_NAMES)
+    RATE_LIMITER.observer = METRICS.observe_api
+    METRICS.gauge('bot_rate_limiter_waiting', 'Bot API requests waiting for the rate limiter', lambda: RATE_LIMITER.depth)
+    METRICS.gauge('bot_admin_outbox_depth', 'Admin notifications waiting to be sent', lambda: ADMIN_OUTBOX.depth)
+    METRICS.gauge('bot_keyboard_cache_size', 'Cached keyboards', lambda: len(KEYBOARD_CACHE.data))
+    METRICS.gauge('bot_keyboard_cache_hits', 'Keyboards served from the cache', lambda: KEYBOARD_CACHE.hits)
+    METRICS.gauge('bot_keyboard_cache_misses', 'Keyboards built because they were not cached', lambda: KEYBOARD_CACHE.misses)
+    METRICS.gauge('bot_schedule_version', 'Schedule version, grows on every change', lambda: SCHEDULE_VERSION)
+    METRICS.gauge('bot_sessions_resident', 'User sessions (user_data) kept in memory', lambda: SESSIONS.resident)
+    METRICS.gauge('bot_sessions_estimated_bytes', 'Estimated memory of user sessions at the last sweep',
+                  lambda: SESSIONS.estimated_bytes)
+
+async def post_init(application):
+    ADMIN_OUTBOX.start(application.bot)
+    if SCHEDULE_WATCH:
+        await SCHEDULE_WATCHER.start()
+    if METRICS_PORT:
+        await METRICS.start_server(METRICS_HOST, METRICS_PORT)
+
+async def post_stop(application):
+    await SCHEDULE_WATCHER.stop()
+    await METRICS.stop_server()
+    await ADMIN_OUTBOX.stop()
+    await ANALYTICS.flush()
+
+async def post_shutdown(application):
+    if SHARED is not None:
+        await SHARED.close()
+    await SCHEDULE_STORAGE.close()
+
+async def run_worker(application):
+    """Запуск в режиме нескольких процессов: вместо run_polling апдейты берутся из общей очереди"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    async with application:
+        await post_init(application)
+        await application.start()
+        logger.info(f"Worker {WORKER_ID} started, shared state in {SHARED_STATE_DB}")
+        # С запасом к MAX_CONCURRENT_UPDATES, чтобы процессору всегда было что взять
+        await SHARED.serve(application, stop, max_in_flight=MAX_CONCURRENT_UPDATES * 2)
+        await application.stop()
+        await post_stop(application)
+    await post_shutdown(application)
+
 def main():
-    application = Application.builder().token(TOKEN).build()
+    mode = BOT_MODE
+    if mode == 'webhook' and not WEBHOOK_URL:
+        logger.warning("BOT_MODE=webhook requires WEBHOOK_URL (public address of the bot), falling back to polling")
+        mode = 'polling'
+    secret = WEBHOOK_SECRET
+    if mode == 'webhook' and not secret:
+        # Без секрета апдейт (в том числе от имени админа) может прислать любой, кто достучится до порта
+        secret = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET is not set, using a random secret token for this run")
+    update_processor = PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES)
+    update_processor.profiler = PROFILER
+    update_processor.shared_state = SHARED
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(update_processor)
+        .rate_limiter(RATE_LIMITER)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    if PERSISTENCE is not None:
+        builder = builder.persistence(PERSISTENCE)
+    application = builder.build()
+    
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(archive_past_dates, interval=ARCHIVE_INTERVAL, first=10)
+        application.job_queue.run_repeating(flush_analytics, interval=ANALYTICS_FLUSH_INTERVAL)
+        application.job_queue.run_repeating(sweep_sessions, interval=SESSION_SWEEP_INTERVAL)
+    else:
+        logger.warning("Job queue is not available, past dates will not be archived, "
+                       "idle sessions will not be evicted and analytics will only be saved on shutdown")
     
     # ConversationHandler для записи
     booking_conv = ConversationHandler(
@@ -903,6 +1600,9 @@ def main():
             CallbackQueryHandler(button_handler, pattern='^back_to_main$'),
             CallbackQueryHandler(button_handler, pattern='^trial$')
         ],
+        name='booking',
+        persistent=PERSISTENCE is not None,
+        conversation_timeout=(CONVERSATION_TIMEOUT or None) if SHARED is None else None,  # в SHARED — см. SharedState
     )
     
     # ConversationHandler для админ-панели (УЛУЧШЕННАЯ ВЕРСИЯ)
@@ -915,15 +1615,39 @@ def main():
             ADMIN_BLOCK_TIME: [CallbackQueryHandler(admin_toggle_time_handler)],
         },
         fallbacks=[CommandHandler('admin', admin_panel)],
+        name='admin',
+        persistent=PERSISTENCE is not None,
+        conversation_timeout=(CONVERSATION_TIMEOUT or None) if SHARED is None else None,  # в SHARED — см. SharedState
     )
     
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("history", admin_history))
+    application.add_handler(CommandHandler("slow", admin_slow))
+    application.add_handler(CommandHandler("stats", admin_stats))
     application.add_handler(booking_conv)
     application.add_handler(admin_conv)
     application.add_handler(CallbackQueryHandler(button_handler))
+    if METRICS_PORT:
+        setup_metrics(application)
+    SESSIONS.attach(application, [booking_conv, admin_conv])
+    if SHARED is not None:
+        SHARED.conversations = {'booking': booking_conv, 'admin': admin_conv}
     
     logger.info("🚀 Бот запущен с улучшенной админ-панелью!")
-    application.run_polling()
+    if SHARED is not None:
+        asyncio.run(run_worker(application))
+    elif mode == 'webhook':
+        # Telegram получает 200 сразу после постановки апдейта в очередь,
+        # обработка идёт параллельно (см. PerUserUpdateProcessor)
+        application.run_webhook(
+            listen='0.0.0.0',
+            port=PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=secret,
+        )
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,195 @@
+import asyncio
+import bisect
+import logging
+import time
+
+from telegram import Update
+from telegram.ext import ConversationHandler, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.values = {}
+
+    def inc(self, *labels, value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{_labels(self.label_names, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus. Корзины хранятся без накопления,
+    суммы по корзинам считаются только при выдаче метрик"""
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values = {}  # метки -> [счётчики корзин..., +Inf, сумма]
+
+    def observe(self, seconds, *labels):
+        data = self.values.get(labels)
+        if data is None:
+            data = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        data[bisect.bisect_left(self.buckets, seconds)] += 1
+        data[-1] += seconds
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labels, data in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), data):
+                total += count
+                le = 'le="%s"' % bound
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, labels, le)} {total}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, labels)} {data[-1]:.6f}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, labels)} {total}')
+        return lines
+
+
+class Gauge:
+    """Значение, которое читается функцией в момент выдачи метрик"""
+
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help = help_text
+        self.read = read
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {self.read()}']
+
+
+class Metrics:
+    """Метрики бота и HTTP-эндпоинт /metrics для Prometheus.
+
+    Пока instrument() не вызван, обработчики не обёрнуты и метрики ничего
+    не стоят; после — на каждый апдейт приходится пара вызовов perf_counter
+    и обновление словаря.
+    """
+
+    def __init__(self):
+        self.updates = Counter('bot_updates_total', 'Updates received, by type', ('type',))
+        self.handler_latency = Histogram('bot_handler_duration_seconds', 'Handler run time', ('handler', 'state'))
+        self.handler_errors = Counter('bot_handler_errors_total', 'Handler exceptions', ('handler', 'state', 'error'))
+        self.api_latency = Histogram('bot_api_request_duration_seconds', 'Bot API request time, without rate limiter waits',
+                                     ('method',))
+        self.api_errors = Counter('bot_api_errors_total', 'Failed Bot API requests', ('method', 'error'))
+        self.gauges = []
+        self._server = None
+
+    def gauge(self, name, help_text, read):
+        self.gauges.append(Gauge(name, help_text, read))
+
+    def render(self):
+        lines = []
+        for metric in (self.updates, self.handler_latency, self.handler_errors, self.api_latency, self.api_errors):
+            lines.extend(metric.render())
+        for gauge in self.gauges:
+            lines.extend(gauge.render())
+        return '\n'.join(lines) + '\n'
+
+    # --- обработчики ---
+
+    def wrap(self, callback, state):
+        name = getattr(callback, '__name__', type(callback).__name__)
+
+        async def timed(update, context):
+            start = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception as e:
+                self.handler_errors.inc(name, state, type(e).__name__)
+                raise
+            finally:
+                self.handler_latency.observe(time.perf_counter() - start, name, state)
+        timed.__name__ = name
+        return timed
+
+    def instrument(self, application, state_names=None):
+        """Оборачивает все зарегистрированные обработчики; состояние диалога берётся из state_names"""
+        state_names = state_names or {}
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler):
+                    for entry in handler.entry_points:
+                        entry.callback = self.wrap(entry.callback, 'entry')
+                    for state, state_handlers in handler.states.items():
+                        for state_handler in state_handlers:
+                            state_handler.callback = self.wrap(state_handler.callback, state_names.get(state, state))
+                    for fallback in handler.fallbacks:
+                        fallback.callback = self.wrap(fallback.callback, 'fallback')
+                else:
+                    handler.callback = self.wrap(handler.callback, '')
+        application.add_handler(TypeHandler(Update, self._count_update), group=-1)
+
+    async def _count_update(self, update, context):
+        self.updates.inc(self._update_type(update))
+
+    @staticmethod
+    def _update_type(update):
+        for kind in ('message', 'callback_query', 'edited_message', 'my_chat_member'):
+            if getattr(update, kind) is not None:
+                return kind
+        return 'other'
+
+    # --- Bot API (вызывается из PriorityRateLimiter) ---
+
+    def observe_api(self, method, seconds, error=None):
+        self.api_latency.observe(seconds, method)
+        if error is not None:
+            self.api_errors.inc(method, type(error).__name__)
+
+    # --- HTTP ---
+
+    async def start_server(self, host, port):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"Metrics endpoint listening on http://{host}:{port}/metrics")
+
+    async def stop_server(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+            writer.write((f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                          f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n').encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
@@ -0,0 +1,122 @@
+import asyncio
+import itertools
+import logging
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 4096
+URGENT, DIGEST = 0, 1  # приоритеты в очереди
+
+
+class AdminOutbox:
+    """Очередь уведомлений администратору.
+
+    Срочные сообщения (заявки) уходят сразу и обгоняют сводки в очереди,
+    несрочные (новые пользователи) копятся и раз в digest_interval секунд
+    отправляются одной сводкой.
+    Отправка ограничена token bucket'ом, при 429 бот ждёт retry_after, при
+    сетевых ошибках повторяет с экспоненциальной задержкой.
+    """
+
+    def __init__(self, chat_id, rate=0.5, burst=5, digest_interval=300, max_attempts=5, send_kwargs=None):
+        self.chat_id = chat_id
+        self.send_kwargs = send_kwargs or {}
+        self.bucket = TokenBucket(rate, burst)
+        self.digest_interval = digest_interval
+        self.max_attempts = max_attempts
+        self.sent = 0
+        self.failed = 0
+        self._digest = []
+        self._seq = itertools.count()
+        self._queue = None
+        self._tasks = []
+        self._bot = None
+
+    @property
+    def depth(self):
+        return (self._queue.qsize() if self._queue else 0) + len(self._digest)
+
+    def start(self, bot):
+        self._bot = bot
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.create_task(self._worker()), asyncio.create_task(self._digest_loop())]
+
+    def send(self, text, digest=False):
+        if digest:
+            self._digest.append(text)
+        elif self._queue is not None:
+            self._put(URGENT, text)
+        else:
+            logger.error(f"Admin outbox is not started, dropping: {text!r}")
+
+    def _put(self, priority, text):
+        self._queue.put_nowait((priority, next(self._seq), text))
+
+    def _flush_digest(self):
+        if not self._digest:
+            return
+        items, self._digest = self._digest, []
+        header = f"📬 *Сводка* ({len(items)})\n\n"
+        message = header
+        for item in items:
+            if len(message) + len(item) + 2 > MESSAGE_LIMIT and message != header:
+                self._put(DIGEST, message.rstrip())
+                message = header
+            message += item + "\n\n"
+        self._put(DIGEST, message.rstrip())
+
+    async def _digest_loop(self):
+        while True:
+            await asyncio.sleep(self.digest_interval)
+            self._flush_digest()
+
+    async def _worker(self):
+        while True:
+            _, _, text = await self._queue.get()
+            try:
+                await self._deliver(text)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, text):
+        parse_mode = 'Markdown'
+        for attempt in range(self.max_attempts):
+            await self.bucket.acquire()
+            try:
+                await self._bot.send_message(chat_id=self.chat_id, text=text, parse_mode=parse_mode, **self.send_kwargs)
+                self.sent += 1
+                return
+            except RetryAfter as e:
+                logger.warning(f"Admin notify flood limit, retry in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if parse_mode is None:
+                    break
+                # Скорее всего, спецсимволы в имени пользователя ломают Markdown
+                logger.warning(f"Admin notify markdown error, resending as plain text: {e}")
+                parse_mode = None
+            except NetworkError as e:
+                delay = min(60, 2 ** attempt)
+                logger.warning(f"Admin notify network error, retry in {delay}s: {e}")
+                await asyncio.sleep(delay)
+            except TelegramError as e:
+                logger.error(f"Notify error: {e}")
+                break
+        self.failed += 1
+        logger.error(f"Admin notification dropped after {attempt + 1} attempts: {text!r}")
+
+    async def stop(self, timeout=10):
+        """Отправляет накопленную сводку и дожидается очереди (при остановке бота)"""
+        if self._queue is None:
+            return
+        self._tasks[1].cancel()
+        self._flush_digest()
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Admin outbox stopped with {self._queue.qsize()} unsent notifications")
+        self._tasks[0].cancel()
@@ -0,0 +1,322 @@
+import asyncio
+import logging
+import sqlite3
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+
+class SessionCodec:
+    """Компактная двоичная запись user_data.
+
+    Известные ключи кодируются одним байтом, частые строковые значения
+    (уровни, инструменты, часовые пояса) — одним байтом индекса, числа —
+    varint, даты — порядковым номером дня. Неизвестные ключи и значения
+    пишутся строками, так что кодек ничего не теряет, просто хуже сжимает.
+    Поддерживаются None, bool, int, str, date и типы из records (классы с
+    to_bytes/from_bytes, например BookingSession).
+
+    Коды — позиции в списках keys, constants и records: менять их порядок
+    нельзя, пока в базе есть сессии, новое дописывается в конец.
+    """
+
+    T_NONE, T_FALSE, T_TRUE, T_INT, T_STR, T_CONST, T_DATE, T_RECORD = range(8)
+    NAMED_KEY = 0xFF
+
+    def __init__(self, keys, constants, records=()):
+        self.keys = tuple(keys)
+        self.key_codes = {key: i for i, key in enumerate(self.keys)}
+        self.constants = tuple(constants)
+        self.constant_codes = {value: i for i, value in enumerate(self.constants)}
+        self.records = tuple(records)
+        self.record_codes = {cls: i for i, cls in enumerate(self.records)}
+        assert len(self.keys) < self.NAMED_KEY and len(self.constants) <= 256 and len(self.records) <= 256
+
+    @staticmethod
+    def _varint(out, n):
+        n = (n << 1) ^ (n >> 63)  # zigzag: небольшие отрицательные тоже короткие
+        while n >= 0x80:
+            out.append(n & 0x7F | 0x80)
+            n >>= 7
+        out.append(n)
+
+    @staticmethod
+    def _read_varint(buf, pos):
+        n = shift = 0
+        while True:
+            b = buf[pos]
+            pos += 1
+            n |= (b & 0x7F) << shift
+            if b < 0x80:
+                return (n >> 1) ^ -(n & 1), pos
+            shift += 7
+
+    def _str(self, out, s):
+        raw = s.encode('utf-8')
+        self._varint(out, len(raw))
+        out += raw
+
+    def _read_str(self, buf, pos):
+        length, pos = self._read_varint(buf, pos)
+        return buf[pos:pos + length].decode('utf-8'), pos + length
+
+    def encode(self, data):
+        out = bytearray()
+        for key, value in data.items():
+            code = self.key_codes.get(key)
+            if code is None:
+                out.append(self.NAMED_KEY)
+                self._str(out, key)
+            else:
+                out.append(code)
+            if value is None:
+                out.append(self.T_NONE)
+            elif isinstance(value, bool):
+                out.append(self.T_TRUE if value else self.T_FALSE)
+            elif isinstance(value, int):
+                out.append(self.T_INT)
+                self._varint(out, value)
+            elif isinstance(value, date):
+                out.append(self.T_DATE)
+                self._varint(out, value.toordinal())
+            elif type(value) in self.record_codes:
+                out.append(self.T_RECORD)
+                out.append(self.record_codes[type(value)])
+                raw = value.to_bytes()
+                self._varint(out, len(raw))
+                out += raw
+            elif isinstance(value, str) and value in self.constant_codes:
+                out.append(self.T_CONST)
+                out.append(self.constant_codes[value])
+            elif isinstance(value, str):
+                out.append(self.T_STR)
+                self._str(out, value)
+            else:
+                raise TypeError(f"Cannot encode {key}={value!r}")
+        return bytes(out)
+
+    def decode(self, buf):
+        data = {}
+        pos = 0
+        while pos < len(buf):
+            code = buf[pos]
+            pos += 1
+            if code == self.NAMED_KEY:
+                key, pos = self._read_str(buf, pos)
+            else:
+                key = self.keys[code]
+            tag = buf[pos]
+            pos += 1
+            if tag == self.T_NONE:
+                value = None
+            elif tag in (self.T_FALSE, self.T_TRUE):
+                value = tag == self.T_TRUE
+            elif tag == self.T_INT:
+                value, pos = self._read_varint(buf, pos)
+            elif tag == self.T_DATE:
+                ordinal, pos = self._read_varint(buf, pos)
+                value = date.fromordinal(ordinal)
+            elif tag == self.T_CONST:
+                value = self.constants[buf[pos]]
+                pos += 1
+            elif tag == self.T_RECORD:
+                cls = self.records[buf[pos]]
+                length, pos = self._read_varint(buf, pos + 1)
+                value = cls.from_bytes(buf[pos:pos + length])
+                pos += length
+            else:
+                value, pos = self._read_str(buf, pos)
+            data[key] = value
+        return data
+
+
+class SessionPersistence(BasePersistence):
+    """Состояния диалогов и user_data в SQLite (только пользователи посреди диалога).
+
+    PTB раз в update_interval передаёт сюда только изменившиеся записи;
+    они копятся и пишутся одной транзакцией в конце каждого такого прохода
+    и при остановке бота. user_data хранится, только пока у пользователя
+    есть незавершённый диалог: когда диалог заканчивается, запись
+    удаляется. Поэтому при запуске читаются лишь активные пользователи, а
+    не все, кто когда-либо писал боту.
+
+    Ключи и частые значения user_data задаются codec (см. SessionCodec).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            chat_id INTEGER,
+            user_id INTEGER,
+            state INTEGER NOT NULL,
+            PRIMARY KEY (name, chat_id, user_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            user_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL
+        );
+    """
+
+    def __init__(self, path, codec, update_interval=10):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True,
+                                                     callback_data=False),
+                         update_interval=update_interval)
+        self.path = path
+        self.codec = codec
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sessions-db')
+        self.conn = self.executor.submit(self._connect).result()
+        self._conversations = None  # имя -> {(chat_id, user_id): состояние}, как в базе после записи
+        self._pending_users = {}  # user_id -> user_data (None — удалить)
+        self._pending_conversations = {}  # (имя, chat_id, user_id) -> состояние (None — диалог закончен)
+        self._writer = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(self.SCHEMA)
+        return conn
+
+    async def _run(self, fn, *args):
+        return await asyncio.wrap_future(self.executor.submit(fn, *args))
+
+    # --- чтение при запуске ---
+
+    def _load_conversations(self):
+        result = {}
+        for name, chat_id, user_id, state in self.conn.execute('SELECT name, chat_id, user_id, state FROM conversations'):
+            result.setdefault(name, {})[(chat_id, user_id)] = state
+        return result
+
+    async def get_conversations(self, name):
+        if self._conversations is None:
+            self._conversations = await self._run(self._load_conversations)
+        return dict(self._conversations.setdefault(name, {}))
+
+    async def get_user_data(self):
+        rows = await self._run(lambda: self.conn.execute('SELECT user_id, data FROM user_sessions').fetchall())
+        result = {}
+        for user_id, data in rows:
+            try:
+                result[user_id] = self.codec.decode(data)
+            except (IndexError, UnicodeDecodeError, ValueError, struct.error) as e:
+                logger.error(f"Session of user {user_id} is damaged, dropping it: {e}")
+        logger.info(f"Restored {len(result)} user sessions from {self.path}")
+        return result
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # --- запись: изменения копятся и уходят одной транзакцией ---
+
+    async def update_conversation(self, name, key, new_state):
+        self._pending_conversations[(name,) + tuple(key)] = new_state
+        self._schedule_write()
+
+    async def update_user_data(self, user_id, data):
+        self._pending_users[user_id] = data
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        self._pending_users[user_id] = None
+        self._schedule_write()
+
+    def _schedule_write(self):
+        # Application.update_persistence вызывает update_* пачкой через gather,
+        # задача записи успевает запуститься только после них всех
+        if self._writer is None:
+            self._writer = asyncio.get_running_loop().create_task(self._write_pending())
+
+    async def _write_pending(self):
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        users, self._pending_users = self._pending_users, {}
+        try:
+            # Состояния после этой пачки; self._conversations меняется только после удачной записи
+            view = {name: dict(states) for name, states in self._conversations.items()}
+            for (name, chat_id, user_id), state in conversations.items():
+                states = view.setdefault(name, {})
+                if state is None:
+                    states.pop((chat_id, user_id), None)
+                else:
+                    states[(chat_id, user_id)] = state
+            # user_data нужна только посреди диалога; закончившим — удаление
+            active = {key[1] for states in view.values() for key in states}
+            ended = {user_id for _, _, user_id in conversations if user_id not in active}
+            rows, dropped = [], []
+            for user_id in ended.union(users):
+                data = users.get(user_id)
+                if not data or user_id not in active:
+                    dropped.append((user_id,))
+                    continue
+                try:
+                    rows.append((user_id, self.codec.encode(data)))
+                except TypeError as e:
+                    # Эти данные не записать, пока они не изменятся (PTB передаст их снова)
+                    logger.error(f"Session of user {user_id} cannot be saved: {e}")
+            await self._run(self._write, conversations, rows, dropped)
+            self._conversations = view
+        except Exception as e:
+            # Пачка возвращается в очередь; более новые изменения тех же ключей важнее
+            for key, state in conversations.items():
+                self._pending_conversations.setdefault(key, state)
+            for user_id, data in users.items():
+                self._pending_users.setdefault(user_id, data)
+            logger.error(f"Session save error, will retry: {e}")
+            asyncio.get_running_loop().call_later(self.update_interval, self._schedule_write)
+        finally:
+            self._writer = None
+
+    def _write(self, conversations, rows, dropped):
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('DELETE FROM conversations WHERE name = ? AND chat_id IS ? AND user_id IS ?',
+                                  [key for key, state in conversations.items() if state is None])
+            self.conn.executemany('INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?)',
+                                  [key + (state,) for key, state in conversations.items() if state is not None])
+            self.conn.executemany('INSERT OR REPLACE INTO user_sessions VALUES (?, ?)', rows)
+            self.conn.executemany('DELETE FROM user_sessions WHERE user_id = ?', dropped)
+
+    async def flush(self):
+        """Дописывает оставшееся и закрывает базу (при остановке бота)"""
+        if self._writer is not None:
+            await self._writer
+        if self._pending_users or self._pending_conversations:
+            self._writer = asyncio.get_running_loop().create_task(self._write_pending())
+            await self._writer
+        if self._pending_users or self._pending_conversations:
+            logger.error(f"Sessions of {len(self._pending_users)} users were not saved on shutdown")
+        await self._run(self.conn.close)
+        self.executor.shutdown(wait=True)
+
+    # --- не используются: chat_data, bot_data и callback_data не хранятся ---
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
@@ -0,0 +1,135 @@
+import asyncio
+import cProfile
+import itertools
+import json
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+
+class _Stepper:
+    """Выполняет корутину по шагам между await и включает профайлер только
+    на время её собственных шагов, чтобы в профиль не попадали другие
+    апдейты, обрабатываемые параллельно. Заодно считает, сколько времени
+    апдейт занимал event loop (busy), а сколько ждал сеть и блокировки"""
+
+    def __init__(self, coroutine, profile=None):
+        self.coroutine = coroutine
+        self.profile = profile
+        self.busy = 0.0
+        self.steps = 0
+
+    def __await__(self):
+        method, arg = self.coroutine.send, None
+        while True:
+            start = time.perf_counter()
+            if self.profile is not None:
+                self.profile.enable()
+            try:
+                yielded = method(arg)
+            except StopIteration as e:
+                return e.value
+            finally:
+                if self.profile is not None:
+                    self.profile.disable()
+                self.busy += time.perf_counter() - start
+                self.steps += 1
+            try:
+                arg = yield yielded
+                method = self.coroutine.send
+            except GeneratorExit:
+                self.coroutine.close()
+                raise
+            except BaseException as e:
+                method, arg = self.coroutine.throw, e
+
+
+def describe_update(update):
+    """(тип, callback_data или команда, user_id) — без текста сообщений пользователей"""
+    if not isinstance(update, Update):
+        return type(update).__name__, None, None
+    user_id = update.effective_user.id if update.effective_user else None
+    if update.callback_query is not None:
+        return 'callback_query', update.callback_query.data, user_id
+    if update.message is not None:
+        text = update.message.text or ''
+        return 'message', text.split()[0] if text.startswith('/') else None, user_id
+    for kind in ('edited_message', 'my_chat_member', 'chat_member'):
+        if getattr(update, kind) is not None:
+            return kind, None, user_id
+    return 'other', None, user_id
+
+
+class UpdateProfiler:
+    """Профилирование обработки апдейтов (включается явно).
+
+    Каждый sample_every-й апдейт профилируется cProfile. Если задан
+    slow_ms, профилируется каждый апдейт, а сохраняются только те, что
+    обрабатывались дольше порога (и выборочные) — это заметно дороже,
+    поэтому порог стоит включать на время поиска проблемы. Профили
+    (.prof для pstats/snakeviz и .json с описанием апдейта) пишутся в
+    directory, старые удаляются, когда файлов больше keep.
+    """
+
+    def __init__(self, directory='profiles', sample_every=0, slow_ms=0, keep=50, history=200):
+        self.directory = directory
+        self.sample_every = sample_every
+        self.slow = slow_ms / 1000
+        self.keep = keep
+        self.recent = deque(maxlen=history)  # последние апдейты: словари с замерами
+        self._counter = itertools.count(1)
+
+    def _write(self, profile, record):
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, record['profile'])
+        profile.dump_stats(base + '.prof')
+        with open(base + '.json', 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False, indent=2)
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith('.prof'))
+        for name in names[:max(0, len(names) - self.keep)]:
+            for path in (os.path.join(self.directory, name), os.path.join(self.directory, name[:-5] + '.json')):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    async def run(self, update, coroutine):
+        sampled = bool(self.sample_every) and next(self._counter) % self.sample_every == 0
+        profile = cProfile.Profile() if sampled or self.slow else None
+        stepper = _Stepper(coroutine, profile)
+        start = time.perf_counter()
+        try:
+            await stepper
+        finally:
+            duration = time.perf_counter() - start
+            kind, data, user_id = describe_update(update)
+            record = {
+                'time': datetime.now().isoformat(timespec='seconds'),
+                'type': kind,
+                'data': data,
+                'user_id': user_id,
+                'duration_ms': round(duration * 1000, 1),
+                'busy_ms': round(stepper.busy * 1000, 1),
+                'steps': stepper.steps,
+                'sampled': sampled,
+                'profile': None,
+            }
+            if profile is not None and (sampled or duration >= self.slow):
+                record['profile'] = f"{datetime.now():%Y%m%d-%H%M%S}-{int(duration * 1000)}ms-{kind}-{user_id}"
+                asyncio.get_running_loop().run_in_executor(None, self._write, profile, record).add_done_callback(
+                    self._log_error)
+            self.recent.append(record)
+
+    @staticmethod
+    def _log_error(future):
+        if future.exception() is not None:
+            logger.error(f"Profile write error: {future.exception()}")
+
+    def slowest(self, n=10):
+        return sorted(self.recent, key=lambda r: r['duration_ms'], reverse=True)[:n]
@@ -0,0 +1,146 @@
+import asyncio
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity в запасе"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self):
+        """Через сколько секунд появится следующий токен"""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while not self.try_acquire():
+            await asyncio.sleep(self.delay())
+
+
+INTERACTIVE, BACKGROUND = 0, 1
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Ограничитель всех запросов бота к Bot API.
+
+    Держит общий бюджет (по умолчанию 30 сообщений/с) и бюджет на каждый чат.
+    Ответы пользователям идут в приоритете: фоновые запросы
+    (rate_limit_args={'priority': BACKGROUND}) ждут, пока есть ожидающие
+    интерактивные. При 429 запрос повторяется после retry_after, а остальные
+    запросы в тот же чат (или все, если чат неизвестен) ждут это же время.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, max_retries=3, max_chats=10000):
+        self.observer = None  # observer(endpoint, секунды, ошибка или None) — для метрик
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.retries = 0
+        self._chat_buckets = {}
+        self._paused_until = {}  # chat_id (None — весь бот) -> time.monotonic()
+        self._waiting = [0, 0]  # ждут любого бюджета, по приоритетам
+        self._global_waiting = [0, 0]  # ждут только общего бюджета
+
+    @property
+    def depth(self):
+        """Сколько запросов сейчас ждут своей очереди"""
+        return self._waiting[INTERACTIVE] + self._waiting[BACKGROUND]
+
+    def stats(self):
+        return {'interactive_waiting': self._waiting[INTERACTIVE], 'background_waiting': self._waiting[BACKGROUND],
+                'chats': len(self._chat_buckets), 'retries': self.retries}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_chats:
+                # Выбрасываем чаты с полным запасом токенов: они давно молчат
+                for key in [k for k, b in self._chat_buckets.items() if b.delay() == 0 and b.tokens >= b.capacity]:
+                    del self._chat_buckets[key]
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _wait_pause(self, chat_id):
+        while True:
+            now = time.monotonic()
+            until = max(self._paused_until.get(None, 0), self._paused_until.get(chat_id, 0))
+            if until <= now:
+                # Истёкшие паузы удаляются, иначе словарь растёт с каждым чатом, получившим 429
+                for key in (None, chat_id):
+                    if key in self._paused_until and self._paused_until[key] <= now:
+                        del self._paused_until[key]
+                return
+            await asyncio.sleep(until - now)
+
+    async def _acquire(self, chat_id, priority, per_chat):
+        self._waiting[priority] += 1
+        try:
+            await self._wait_pause(chat_id)
+            if per_chat:
+                await self._chat_bucket(chat_id).acquire()
+            self._global_waiting[priority] += 1
+            try:
+                while True:
+                    if priority == INTERACTIVE or not self._global_waiting[INTERACTIVE]:
+                        if self.global_bucket.try_acquire():
+                            return
+                    await asyncio.sleep(max(self.global_bucket.delay(), 0.005))
+            finally:
+                self._global_waiting[priority] -= 1
+        finally:
+            self._waiting[priority] -= 1
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = (rate_limit_args or {}).get('priority', INTERACTIVE)
+        chat_id = data.get('chat_id')
+        # Бюджет чата тратят только новые сообщения; правки клавиатур
+        # (переключение слотов в админке) и ответы на колбэки — нет
+        per_chat = chat_id is not None and endpoint.startswith('send')
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, priority, per_chat)
+            try:
+                if self.observer is None:
+                    return await callback(*args, **kwargs)
+                return await self._observed(endpoint, callback, args, kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                self._paused_until[chat_id] = time.monotonic() + e.retry_after
+
+    async def _observed(self, endpoint, callback, args, kwargs):
+        start = time.perf_counter()
+        try:
+            result = await callback(*args, **kwargs)
+        except Exception as e:
+            self.observer(endpoint, time.perf_counter() - start, e)
+            raise
+        self.observer(endpoint, time.perf_counter() - start, None)
+        return result
@@ -0,0 +1,95 @@
+import logging
+import sys
+import time
+from collections import OrderedDict
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_size(data):
+    """Примерный размер user_data в байтах: сам словарь, ключи и значения (без общих объектов Python)"""
+    size = sys.getsizeof(data)
+    for key, value in data.items():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+    return size
+
+
+class SessionTracker:
+    """Ограничение памяти под сессии пользователей (user_data и состояния диалогов).
+
+    Пользователи хранятся в порядке последней активности (OrderedDict как
+    LRU). Периодическая очистка (sweep) выселяет тех, кто молчит дольше
+    ttl, и, если оценка памяти всё ещё больше max_bytes, — самых давних.
+    Число сессий ограничено max_sessions сразу, при появлении нового
+    пользователя. Выселение удаляет user_data (через Application, поэтому
+    и из persistence) и состояния пользователя во всех conversations.
+    В режиме SharedState выселяется только копия в памяти воркера: сессия
+    остаётся в общей базе и загружается оттуда при следующем апдейте.
+    """
+
+    def __init__(self, ttl=86400.0, max_sessions=50000, max_bytes=64 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.conversations = []  # ConversationHandler'ы, чьи состояния выселяются вместе с user_data
+        self.estimated_bytes = 0  # по последней очистке
+        self.evicted = 0
+        self._seen = OrderedDict()  # user_id -> time.monotonic() последнего апдейта
+        self._application = None
+
+    def attach(self, application, conversations, group=-2):
+        """Отслеживает активность пользователей (вызывается после регистрации обработчиков)"""
+        self._application = application
+        self.conversations = list(conversations)
+        application.add_handler(TypeHandler(Update, self._touch), group=group)
+
+    @property
+    def resident(self):
+        return len(self._application.user_data) if self._application is not None else 0
+
+    async def _touch(self, update, context):
+        user = update.effective_user
+        if user is None:
+            return
+        self._seen[user.id] = time.monotonic()
+        self._seen.move_to_end(user.id)
+        while len(self._seen) > self.max_sessions:
+            self.evict(next(iter(self._seen)))
+
+    def evict(self, user_id):
+        self._seen.pop(user_id, None)
+        if user_id in self._application.user_data:
+            self._application.drop_user_data(user_id)
+        for handler in self.conversations:
+            # Ключ диалога по умолчанию — (chat_id, user_id); публичного способа сбросить его у PTB нет
+            for key in [k for k in handler._conversations if k[-1] == user_id]:
+                handler._conversations.pop(key, None)
+        self.evicted += 1
+
+    def sweep(self):
+        """Выселяет неактивных и лишних по памяти. Возвращает число выселенных"""
+        before = self.evicted
+        now = time.monotonic()
+        # Данные, которых трекер не видел (например, восстановленные persistence), считаются свежими
+        for user_id in self._application.user_data:
+            if user_id not in self._seen:
+                self._seen[user_id] = now
+                self._seen.move_to_end(user_id, last=False)
+        while self._seen:
+            user_id, seen = next(iter(self._seen.items()))
+            if now - seen < self.ttl:
+                break
+            self.evict(user_id)
+        sizes = {user_id: estimate_size(data) for user_id, data in self._application.user_data.items()}
+        self.estimated_bytes = sum(sizes.values())
+        while self.estimated_bytes > self.max_bytes and self._seen:
+            user_id = next(iter(self._seen))
+            self.estimated_bytes -= sizes.get(user_id, 0)
+            self.evict(user_id)
+        evicted = self.evicted - before
+        if evicted:
+            logger.info(f"Evicted {evicted} idle sessions, {self.resident} resident, ~{self.estimated_bytes} bytes")
+        return evicted
@@ -0,0 +1,296 @@
+import asyncio
+import json
+import logging
+import pickle
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Update
+from telegram.error import Conflict, TelegramError
+
+from update_processor import update_key
+
+logger = logging.getLogger(__name__)
+
+
+def _key_str(key):
+    return f'{key[0]}:{key[1]}'
+
+
+class SharedState:
+    """Общее состояние нескольких процессов бота (SQLite в режиме WAL).
+
+    Один процесс — лидер, выбранный по аренде в таблице leader, — забирает
+    апдейты через getUpdates и складывает их в update_queue. Обрабатывают
+    очередь все процессы: каждый забирает самый старый апдейт, у ключа
+    (chat_id, user_id) которого нет более ранних необработанных апдейтов,
+    поэтому апдейты одного пользователя идут строго по очереди, даже если
+    попадают в разные процессы. Перед обработкой апдейта из базы
+    подгружаются состояния диалогов и user_data этого пользователя, после —
+    сохраняются вместе с удалением апдейта из очереди. Строка сессии живёт,
+    пока у пользователя есть незавершённый диалог; диалог, молчащий дольше
+    session_timeout, при загрузке считается завершённым (таймеры
+    ConversationHandler в этом режиме не работают — они видят только свой
+    процесс). Изменения расписания
+    видны по PRAGMA data_version файла расписания; свои записи процесс
+    отличает по счётчику version (SqliteScheduleStorage.local_writes).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS leader (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            worker TEXT,
+            expires_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS update_queue (
+            update_id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            worker TEXT,
+            claimed_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS update_queue_key ON update_queue (key, update_id);
+        CREATE TABLE IF NOT EXISTS sessions (
+            key TEXT PRIMARY KEY,
+            user_data BLOB,
+            conversations TEXT,
+            updated_at REAL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS shared_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path, worker_id, schedule_storage, lease=15.0, claim_timeout=120.0, poll_timeout=5):
+        self.path = path
+        self.worker_id = worker_id
+        self.lease = lease
+        self.claim_timeout = claim_timeout
+        self.poll_timeout = poll_timeout
+        self.conversations = {}  # имя -> ConversationHandler
+        self.on_schedule_change = None  # async-функция, перечитывающая расписание
+        self.session_timeout = None  # секунды, после которых незавершённый диалог сбрасывается
+        self.is_leader = False
+        self.in_flight = 0  # апдейты, взятые из очереди и ещё не обработанные
+        self._application = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shared-state')
+        self.conn = self._call(self._connect, path, True)
+        self.schedule_storage = schedule_storage
+        self.schedule_conn = self._call(self._connect, schedule_storage.path, False)
+        self._data_version = None
+        self._seen_version = None  # (счётчик version в базе, local_writes) на момент последней проверки
+
+    def _call(self, fn, *args):
+        return self.executor.submit(fn, *args).result()
+
+    async def _run(self, fn, *args):
+        return await asyncio.wrap_future(self.executor.submit(fn, *args))
+
+    def _connect(self, path, create):
+        conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=10)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        if create:
+            conn.executescript(self.SCHEMA)
+            conn.execute('INSERT OR IGNORE INTO leader VALUES (1, NULL, 0)')
+        return conn
+
+    # --- сессии ---
+
+    def _schedule_changed(self):
+        """True, если расписание в базе изменил другой процесс"""
+        data_version = self.schedule_conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return False
+        self._data_version = data_version
+        seen = self.schedule_storage.write_counters()
+        previous, self._seen_version = self._seen_version, seen
+        return previous is not None and seen[0] - previous[0] != seen[1] - previous[1]
+
+    def _load_session(self, key):
+        changed = self._schedule_changed()
+        row = self.conn.execute('SELECT user_data, conversations, updated_at FROM sessions WHERE key = ?',
+                                (key,)).fetchone()
+        if row is not None and self.session_timeout and row[2] < time.time() - self.session_timeout:
+            row = None  # брошенный диалог: начинаем с чистого листа
+        return changed, row
+
+    def _finish(self, update_id, key=None, user_data=None, conversations=None):
+        """Сохраняет сессию (или удаляет, если диалогов не осталось) и удаляет апдейт из очереди одной транзакцией"""
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            if key is not None and conversations is None:
+                self.conn.execute('DELETE FROM sessions WHERE key = ?', (key,))
+            elif key is not None:
+                self.conn.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)',
+                                  (key, user_data, conversations, time.time()))
+            self.conn.execute('DELETE FROM update_queue WHERE update_id = ? AND worker = ?', (update_id, self.worker_id))
+
+    async def run(self, update, coroutine):
+        """Обработка одного апдейта: состояние пользователя из базы -> обработчики -> обратно в базу"""
+        try:
+            key = update_key(update)
+            if key is None:
+                await coroutine
+                await self._run(self._finish, update.update_id)
+                return
+            changed, row = await self._run(self._load_session, _key_str(key))
+            if changed and self.on_schedule_change is not None:
+                await self.on_schedule_change()
+            user_data = self._application.user_data[key[1]] if key[1] is not None else None
+            if user_data is not None:
+                user_data.clear()
+                if row is not None and row[0] is not None:
+                    user_data.update(pickle.loads(row[0]))
+            states = json.loads(row[1]) if row is not None and row[1] else {}
+            for name, handler in self.conversations.items():
+                # Публичного способа задать состояние диалога у ConversationHandler нет
+                if name in states:
+                    handler._conversations[key] = states[name]
+                else:
+                    handler._conversations.pop(key, None)
+            try:
+                await coroutine
+            finally:
+                states = {name: handler._conversations[key] for name, handler in self.conversations.items()
+                          if isinstance(handler._conversations.get(key), int)}
+                data = pickle.dumps(dict(user_data)) if user_data else None
+                await self._run(self._finish, update.update_id, _key_str(key), data,
+                                json.dumps(states) if states else None)
+        finally:
+            self.in_flight -= 1
+
+    def _prune_sessions(self, before):
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            return self.conn.execute('DELETE FROM sessions WHERE updated_at < ?', (before,)).rowcount
+
+    async def prune_sessions(self, max_age):
+        """Удаляет сессии, молчащие дольше max_age секунд. Возвращает число удалённых"""
+        return await self._run(self._prune_sessions, time.time() - max_age)
+
+    # --- лидер ---
+
+    def _try_lead(self):
+        now = time.time()
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            acquired = self.conn.execute(
+                'UPDATE leader SET worker = ?, expires_at = ? WHERE id = 1 AND (worker = ? OR worker IS NULL OR expires_at < ?)',
+                (self.worker_id, now + self.lease, self.worker_id, now)).rowcount == 1
+            if acquired:
+                # Апдейты, взятые упавшими процессами, возвращаются в очередь
+                self.conn.execute('UPDATE update_queue SET worker = NULL, claimed_at = NULL '
+                                  'WHERE worker IS NOT NULL AND claimed_at < ?', (now - self.claim_timeout,))
+        return acquired
+
+    def _resign(self):
+        self.conn.execute('UPDATE leader SET worker = NULL, expires_at = 0 WHERE id = 1 AND worker = ?', (self.worker_id,))
+
+    def _offset(self):
+        row = self.conn.execute("SELECT value FROM shared_meta WHERE key = 'offset'").fetchone()
+        return int(row[0]) if row else None
+
+    def _enqueue(self, rows, offset):
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('INSERT OR IGNORE INTO update_queue (update_id, key, payload) VALUES (?, ?, ?)', rows)
+            self.conn.execute("INSERT OR REPLACE INTO shared_meta VALUES ('offset', ?)", (str(offset),))
+
+    async def _elect(self, stop):
+        while not stop.is_set():
+            leader = await self._run(self._try_lead)
+            if leader != self.is_leader:
+                logger.info(f"Worker {self.worker_id} {'is now the leader' if leader else 'lost leadership'}")
+                self.is_leader = leader
+            try:
+                await asyncio.wait_for(stop.wait(), self.lease / 3)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _poll(self, bot, stop):
+        """Цикл лидера: getUpdates -> update_queue"""
+        webhook_deleted = False
+        while not stop.is_set():
+            if not self.is_leader:
+                await asyncio.sleep(0.5)
+                continue
+            try:
+                if not webhook_deleted:
+                    await bot.delete_webhook()
+                    webhook_deleted = True
+                updates = await bot.get_updates(offset=await self._run(self._offset), timeout=self.poll_timeout,
+                                                allowed_updates=Update.ALL_TYPES)
+            except Conflict as e:
+                # Предыдущий лидер ещё не закончил свой getUpdates
+                logger.warning(f"getUpdates conflict: {e}")
+                await asyncio.sleep(1)
+                continue
+            except TelegramError as e:
+                logger.error(f"getUpdates error: {e}")
+                await asyncio.sleep(1)
+                continue
+            if updates:
+                rows = [(u.update_id, _key_str(update_key(u)) if update_key(u) else f'update:{u.update_id}',
+                         json.dumps(u.to_dict(), ensure_ascii=False)) for u in updates]
+                await self._run(self._enqueue, rows, updates[-1].update_id + 1)
+
+    # --- обработка очереди ---
+
+    CLAIMABLE = ('SELECT update_id, payload FROM update_queue q WHERE worker IS NULL AND NOT EXISTS '
+                 '(SELECT 1 FROM update_queue p WHERE p.key = q.key AND p.update_id < q.update_id) '
+                 'ORDER BY update_id LIMIT ?')
+
+    def _claim(self, limit):
+        # Сначала обычное чтение: пустая очередь не требует блокировки записи,
+        # которая мешала бы лидеру (_enqueue) и обработке (_finish)
+        if not self.conn.execute(self.CLAIMABLE, (1,)).fetchone():
+            return []
+        now = time.time()
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            rows = self.conn.execute(self.CLAIMABLE, (limit,)).fetchall()
+            self.conn.executemany('UPDATE update_queue SET worker = ?, claimed_at = ? WHERE update_id = ?',
+                                  [(self.worker_id, now, update_id) for update_id, _ in rows])
+        return rows
+
+    def _release_claims(self):
+        self.conn.execute('UPDATE update_queue SET worker = NULL, claimed_at = NULL WHERE worker = ?', (self.worker_id,))
+
+    async def _consume(self, application, stop, max_in_flight, idle_min=0.02, idle_max=0.25):
+        idle = idle_min
+        while not stop.is_set():
+            free = max_in_flight - self.in_flight
+            if free <= 0:
+                await asyncio.sleep(idle_min)
+                continue
+            rows = await self._run(self._claim, free)
+            if not rows:
+                # Очередь пуста: опрашиваем всё реже, до idle_max
+                await asyncio.sleep(idle)
+                idle = min(idle * 2, idle_max)
+                continue
+            idle = idle_min
+            for _, payload in rows:
+                self.in_flight += 1
+                await application.update_queue.put(Update.de_json(json.loads(payload), application.bot))
+
+    async def serve(self, application, stop, max_in_flight=64):
+        """Работает, пока не выставлен stop: выборы лидера, getUpdates у лидера, обработка очереди"""
+        self._application = application
+        tasks = [asyncio.create_task(self._elect(stop)), asyncio.create_task(self._poll(application.bot, stop)),
+                 asyncio.create_task(self._consume(application, stop, max_in_flight))]
+        await stop.wait()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._run(self._resign)
+
+    async def close(self):
+        """Возвращает в очередь взятые, но не обработанные апдейты (при остановке процесса)"""
+        await self._run(self._release_claims)
+        await self._run(self.conn.close)
+        await self._run(self.schedule_conn.close)
+        self.executor.shutdown(wait=True)
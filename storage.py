@@ -0,0 +1,542 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def atomic_write(path, data):
+    """Пишет байты во временный файл рядом с path, делает fsync и переименовывает"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def file_signature(path):
+    """(mtime, размер, inode) файла или None, если его нет"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def write_signed(path, data):
+    """atomic_write, возвращающий подпись записанного файла"""
+    atomic_write(path, data)
+    return file_signature(path)
+
+
+def dump_json(obj):
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+def apply_slot_op(schedule, section, key, slot, blocked):
+    """Блокирует/разблокирует слот в словаре расписания. Возвращает True, если он изменился"""
+    slots = schedule[section].get(key, [])
+    if (slot in slots) == blocked:
+        return False
+    if blocked:
+        schedule[section][key] = sorted(slots + [slot])
+    else:
+        slots = [s for s in slots if s != slot]
+        if slots:
+            schedule[section][key] = slots
+        else:
+            schedule[section].pop(key, None)
+    return True
+
+
+class ScheduleJournal:
+    """Журнал изменений расписания (JSON lines), дописываемый в конец.
+
+    Каждая операция — одна короткая строка, поэтому изменение стоит O(1)
+    вместо перезаписи всего файла. Строка сбрасывается в ОС сразу, так что
+    переживает внезапное завершение процесса. При сжатии журнал
+    переименовывается в *.compacting и удаляется после записи снимка.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rotated_path = path + '.compacting'
+        self.entries = 0
+        self.replayed = 0
+        self._file = None
+
+    def append(self, section, key, slot, blocked):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        record = {'op': 'block' if blocked else 'unblock', 'section': section, 'key': key, 'slot': slot}
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+        self.entries += 1
+
+    def replay(self, schedule):
+        """Применяет к снимку операции из журнала. Возвращает число прочитанных записей"""
+        count = 0
+        for path in (self.rotated_path, self.path):
+            try:
+                f = open(path, 'r', encoding='utf-8')
+            except FileNotFoundError:
+                continue
+            with f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        section = record['section']
+                        if section not in ('weekly_blocked', 'specific_dates'):
+                            raise ValueError(section)
+                        apply_slot_op(schedule, section, record['key'], record['slot'], record['op'] == 'block')
+                        count += 1
+                    except (ValueError, KeyError, TypeError):
+                        # Оборванная при падении последняя строка
+                        logger.warning(f"Skipping bad journal line in {path}: {line!r}")
+        self.replayed = count
+        return count
+
+    def exists(self):
+        return os.path.exists(self.path) or os.path.exists(self.rotated_path)
+
+    def rotate(self):
+        """Откладывает текущий журнал перед записью снимка"""
+        self.close()
+        if not os.path.exists(self.path):
+            return
+        if os.path.exists(self.rotated_path):
+            # Предыдущее сжатие не завершилось: склеиваем, чтобы ничего не потерять
+            with open(self.path, 'rb') as src, open(self.rotated_path, 'ab') as dst:
+                dst.write(src.read())
+            os.unlink(self.path)
+        else:
+            os.replace(self.path, self.rotated_path)
+        self.entries = 0
+
+    def discard_rotated(self):
+        try:
+            os.unlink(self.rotated_path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ScheduleWriter:
+    """Отложенная (write-behind) запись расписания.
+
+    mark_dirty() только помечает данные изменёнными; через delay секунд после
+    первой пометки текущее состояние сериализуется и пишется в файл в пуле
+    потоков. Серия изменений за это время превращается в одну запись.
+    Если передан journal, запись снимка одновременно сжимает журнал.
+    """
+
+    def __init__(self, path, get_data, delay=1.0, journal=None):
+        self.path = path
+        self.get_data = get_data
+        self.delay = delay
+        self.journal = journal
+        self.dirty = False
+        self.writes = 0
+        self.signature = None  # file_signature после нашей последней записи
+        self._task = None
+        self._sleeping = False
+        self._lock = None  # создаётся внутри event loop
+
+    def mark_dirty(self):
+        self.dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Вне event loop (скрипты, миграции) пишем сразу
+            self.write_now()
+            return
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        # Изменения, пришедшие во время записи, попадут в следующий проход
+        while self.dirty:
+            self._sleeping = True
+            try:
+                await asyncio.sleep(self.delay)
+            finally:
+                self._sleeping = False
+            await self.flush()
+
+    async def flush(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            # Сериализуем в потоке event loop, чтобы снимок был согласованным
+            data = dump_json(self.get_data())
+            if self.journal is not None:
+                self.journal.rotate()
+            try:
+                self.signature = await asyncio.get_running_loop().run_in_executor(None, write_signed, self.path, data)
+                self.writes += 1
+                if self.journal is not None:
+                    self.journal.discard_rotated()
+            except OSError as e:
+                self.dirty = True
+                logger.error(f"Schedule write error: {e}")
+
+    def write_now(self):
+        self.dirty = False
+        data = dump_json(self.get_data())
+        if self.journal is not None:
+            self.journal.rotate()
+        self.signature = write_signed(self.path, data)
+        self.writes += 1
+        if self.journal is not None:
+            self.journal.discard_rotated()
+
+    async def close(self):
+        """Дописывает отложенные изменения (вызывается при остановке бота)"""
+        task = self._task
+        if task is not None and not task.done():
+            if self._sleeping:
+                task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        if self.journal is not None:
+            self.journal.close()
+
+
+# ====================================
+# ХРАНИЛИЩА РАСПИСАНИЯ
+# ====================================
+# Общий интерфейс бэкендов:
+#   load(default)                      -> словарь расписания
+#   save(schedule)                     -> полная перезапись
+#   record(section, key, slot, blocked) -> одно изменение
+#   load_bookings(since)               -> записи учеников на даты >= since
+#   record_booking(booking)            -> сохранить запись {'date', 'slot', ...}
+#   forget_dates(before)               -> удалить specific_dates раньше before (уже в архиве)
+#   close()                            -> async, дописывает всё на диск
+
+def _in_range(date_str, start, end):
+    return (start is None or date_str >= start) and (end is None or date_str < end)
+
+
+class JsonScheduleStorage:
+    """schedule.json + журнал изменений со сжатием в фоне"""
+
+    def __init__(self, path, journal_path, get_data, compact_delay=30.0, bookings_path='bookings.jsonl'):
+        self.path = path
+        self.get_data = get_data
+        self.bookings_path = bookings_path
+        self._bookings_file = None
+        self.journal = ScheduleJournal(journal_path)
+        self.writer = ScheduleWriter(path, get_data, delay=compact_delay, journal=self.journal)
+
+    def load(self, default):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                schedule = json.load(f)
+        except FileNotFoundError:
+            schedule = default
+        if self.journal.replay(schedule):
+            logger.info(f"Replayed {self.journal.replayed} schedule journal entries")
+        if self.journal.exists():
+            self.save(schedule)  # сворачиваем журнал, оставшийся от прошлого запуска
+        return schedule
+
+    def save(self, schedule):
+        self.journal.rotate()
+        self.writer.signature = write_signed(self.path, dump_json(schedule))
+        self.journal.discard_rotated()
+
+    @property
+    def written_signature(self):
+        """Подпись schedule.json после последней записи ботом: такие изменения файла — не правка снаружи"""
+        return self.writer.signature
+
+    def adopt(self, signature):
+        """Расписание в памяти заменено содержимым файла, изменённого снаружи.
+        Журнал относится к старому снимку и при перезапуске испортил бы новый — он удаляется"""
+        self.journal.rotate()
+        self.journal.discard_rotated()
+        self.writer.signature = signature
+
+    def record(self, section, key, slot, blocked):
+        self.journal.append(section, key, slot, blocked)
+        self.writer.mark_dirty()
+
+    def load_bookings(self, since=None):
+        bookings = []
+        try:
+            f = open(self.bookings_path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return bookings
+        with f:
+            for line in f:
+                try:
+                    booking = json.loads(line)
+                    if _in_range(booking['date'], since, None):
+                        bookings.append(booking)
+                except (ValueError, KeyError, TypeError):
+                    logger.warning(f"Skipping bad booking line: {line!r}")
+        return bookings
+
+    def record_booking(self, booking):
+        if self._bookings_file is None:
+            self._bookings_file = open(self.bookings_path, 'a', encoding='utf-8')
+        self._bookings_file.write(json.dumps(booking, ensure_ascii=False) + '\n')
+        self._bookings_file.flush()
+
+    def forget_dates(self, before):
+        # Даты уже удалены из словаря в памяти, снимок перепишется при сжатии
+        self.writer.mark_dirty()
+
+    async def close(self):
+        await self.writer.close()
+        if self._bookings_file is not None:
+            self._bookings_file.close()
+            self._bookings_file = None
+
+
+class SqliteScheduleStorage:
+    """Расписание в SQLite (WAL).
+
+    Заблокированные слоты лежат в двух таблицах с первичными ключами
+    (weekday, slot) и (date, slot), поэтому выборка диапазона дат — один
+    запрос по индексу. Соединение одно на всё время работы; все обращения
+    идут через единственный рабочий поток, который заодно упорядочивает
+    записи и не даёт им блокировать event loop.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS weekly_blocked (
+            weekday TEXT NOT NULL,
+            slot TEXT NOT NULL,
+            PRIMARY KEY (weekday, slot)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS specific_blocked (
+            date TEXT NOT NULL,
+            slot TEXT NOT NULL,
+            PRIMARY KEY (date, slot)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS bookings (
+            date TEXT NOT NULL,
+            slot TEXT NOT NULL,
+            user_id INTEGER,
+            data TEXT NOT NULL,
+            PRIMARY KEY (date, slot)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    BUMP_VERSION = "UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'version'"
+
+    def __init__(self, path):
+        self.path = path
+        self.local_writes = 0  # транзакции этого процесса, увеличившие счётчик version
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='schedule-db')
+        self.conn = self._call(self._connect)
+
+    def _call(self, fn, *args):
+        return self.executor.submit(fn, *args).result()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(self.SCHEMA)
+        conn.execute("INSERT OR IGNORE INTO meta VALUES ('version', '0')")
+        return conn
+
+    def _write(self, sql, params=()):
+        """Одно изменение вместе с увеличением счётчика version: по нему процессы
+        с общей базой отличают чужие изменения от своих (см. SharedState)"""
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self.conn.execute(sql, params)
+            self.conn.execute(self.BUMP_VERSION)
+        self.local_writes += 1
+
+    def write_counters(self):
+        """(счётчик version в базе, local_writes) — читаются в потоке записи, поэтому согласованы"""
+        return self._call(lambda: (int(self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]),
+                                   self.local_writes))
+
+    def is_initialized(self):
+        return self._call(lambda: self.conn.execute("SELECT 1 FROM meta WHERE key = 'initialized'").fetchone() is not None)
+
+    def load(self, default, migrate_from=None):
+        """При первом запуске переносит данные из migrate_from (JsonScheduleStorage) или default"""
+        if not self.is_initialized():
+            schedule = migrate_from.load(default) if migrate_from is not None else default
+            bookings = migrate_from.load_bookings() if migrate_from is not None else []
+            if self._call(self._initialize, schedule, bookings):
+                logger.info(f"Schedule database {self.path} initialized"
+                            + (f" from {migrate_from.path}" if migrate_from is not None else ""))
+        return self._call(self._load)
+
+    def _initialize(self, schedule, bookings):
+        """Первое заполнение базы одной транзакцией. False, если другой процесс
+        (воркер SHARED_STATE_DB, запущенный одновременно) успел раньше"""
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            if self.conn.execute("SELECT 1 FROM meta WHERE key = 'initialized'").fetchone() is not None:
+                return False
+            self._replace(schedule)
+            self.conn.executemany('INSERT OR IGNORE INTO bookings VALUES (?, ?, ?, ?)',
+                                  [self._booking_row(booking) for booking in bookings])
+            self.conn.execute(self.BUMP_VERSION)
+        self.local_writes += 1
+        return True
+
+    def _load(self):
+        schedule = {'weekly_blocked': {}, 'specific_dates': {}}
+        for weekday, slot in self.conn.execute('SELECT weekday, slot FROM weekly_blocked ORDER BY weekday, slot'):
+            schedule['weekly_blocked'].setdefault(weekday, []).append(slot)
+        for date, slot in self.conn.execute('SELECT date, slot FROM specific_blocked ORDER BY date, slot'):
+            schedule['specific_dates'].setdefault(date, []).append(slot)
+        return schedule
+
+    def save(self, schedule):
+        self._call(self._save, schedule)
+
+    def _save(self, schedule):
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self._replace(schedule)
+            self.conn.execute(self.BUMP_VERSION)
+        self.local_writes += 1
+
+    def _replace(self, schedule):
+        self.conn.execute('DELETE FROM weekly_blocked')
+        self.conn.execute('DELETE FROM specific_blocked')
+        self.conn.executemany('INSERT OR IGNORE INTO weekly_blocked VALUES (?, ?)',
+                              [(k, s) for k, slots in schedule['weekly_blocked'].items() for s in slots])
+        self.conn.executemany('INSERT OR IGNORE INTO specific_blocked VALUES (?, ?)',
+                              [(k, s) for k, slots in schedule['specific_dates'].items() for s in slots])
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('initialized', '1')")
+
+    def record(self, section, key, slot, blocked):
+        table = 'weekly_blocked' if section == 'weekly_blocked' else 'specific_blocked'
+        if blocked:
+            sql = f'INSERT OR IGNORE INTO {table} VALUES (?, ?)'
+        else:
+            sql = f"DELETE FROM {table} WHERE {'weekday' if table == 'weekly_blocked' else 'date'} = ? AND slot = ?"
+        future = self.executor.submit(self._write, sql, (key, slot))
+        future.add_done_callback(self._log_error)
+
+    @staticmethod
+    def _log_error(future):
+        if future.exception() is not None:
+            logger.error(f"Schedule database write error: {future.exception()}")
+
+    def load_bookings(self, since=None):
+        rows = self._call(lambda: self.conn.execute('SELECT data FROM bookings WHERE date >= ? ORDER BY date, slot',
+                                                    (since or '',)).fetchall())
+        return [json.loads(data) for data, in rows]
+
+    async def reload(self, since=None):
+        """(расписание, записи на даты >= since) одним согласованным чтением —
+        после изменений, сделанных другими процессами"""
+        return await asyncio.wrap_future(self.executor.submit(self._reload, since or ''))
+
+    def _reload(self, since):
+        with self.conn:
+            self.conn.execute('BEGIN')
+            bookings = [json.loads(data) for data, in
+                        self.conn.execute('SELECT data FROM bookings WHERE date >= ? ORDER BY date, slot', (since,))]
+            return self._load(), bookings
+
+    def record_booking(self, booking):
+        self.executor.submit(self._insert_booking, booking).add_done_callback(self._log_error)
+
+    async def claim_booking(self, booking):
+        """Записывает ученика и ждёт результата. False, если слот уже занят (в том числе другим процессом)"""
+        try:
+            await asyncio.wrap_future(self.executor.submit(self._insert_booking, booking))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def forget_dates(self, before):
+        future = self.executor.submit(self._write, 'DELETE FROM specific_blocked WHERE date < ?', (before,))
+        future.add_done_callback(self._log_error)
+
+    def _insert_booking(self, booking):
+        # Первичный ключ (date, slot) не даст записать второго ученика на тот же слот
+        self._write('INSERT INTO bookings VALUES (?, ?, ?, ?)', self._booking_row(booking))
+
+    @staticmethod
+    def _booking_row(booking):
+        return booking['date'], booking['slot'], booking.get('user_id'), json.dumps(booking, ensure_ascii=False)
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.executor.submit(self.conn.close).result)
+        self.executor.shutdown(wait=True)
+
+
+class ScheduleArchive:
+    """Архив прошедших блокировок: gzip с JSON lines {"date", "slots"}.
+
+    Каждый перенос дописывается в конец файла отдельным gzip-блоком, поэтому
+    старые данные не перепаковываются, а файл по-прежнему читается как один
+    поток. Оборванный при сбое последний блок при чтении пропускается.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, dates):
+        lines = ''.join(json.dumps({'date': d, 'slots': slots}, ensure_ascii=False) + '\n'
+                        for d, slots in sorted(dates.items()))
+        with open(self.path, 'ab') as f:
+            f.write(gzip.compress(lines.encode('utf-8')))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def query(self, start=None, end=None):
+        """{дата ISO: [слоты]} для start <= дата < end"""
+        result = {}
+        try:
+            f = gzip.open(self.path, 'rt', encoding='utf-8')
+        except FileNotFoundError:
+            return result
+        with f:
+            try:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        date_str, slots = entry['date'], entry['slots']
+                    except (ValueError, KeyError, TypeError):
+                        logger.warning(f"Skipping bad archive line: {line!r}")
+                        continue
+                    if _in_range(date_str, start, end):
+                        result[date_str] = sorted(set(result.get(date_str, [])) | set(slots))
+            except (EOFError, OSError) as e:
+                logger.warning(f"Schedule archive {self.path} is truncated: {e}")
+        return dict(sorted(result.items()))
@@ -0,0 +1,29 @@
+import os
+import struct
+import sys
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from booking import BookingSession, Instrument, Level, Timezone  # noqa: E402
+
+
+def test_each_funnel_step_is_reached_once():
+    session = BookingSession()
+    assert session.reach('timezone')
+    assert not session.reach('timezone')  # повторный выбор после «назад»
+    assert session.has_reached('timezone') and not session.has_reached('booked')
+
+
+def test_round_trip_keeps_reached_steps():
+    session = BookingSession(Level.BEGINNER, Instrument.ACOUSTIC, Timezone.CUSTOM, -2, date(2026, 10, 20), 7)
+    for step in ('start', 'booking', 'level'):
+        session.reach(step)
+    restored = BookingSession.from_bytes(session.to_bytes())
+    assert repr(restored) == repr(session)
+
+
+def test_records_without_reached_steps_are_read():
+    old = struct.pack('<BBBbIB', Level.EXPERIENCED, Instrument.ELECTRIC, Timezone.UTC5, 0, date(2026, 10, 20).toordinal(), 0)
+    session = BookingSession.from_bytes(old)
+    assert session.timezone is Timezone.UTC5 and session.reached == 0
@@ -0,0 +1,45 @@
+import asyncio
+import os
+import sqlite3
+import sys
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from persistence import SessionCodec, SessionPersistence  # noqa: E402
+
+CODEC = SessionCodec(keys=['level', 'date'], constants=['Новичок'])
+
+
+def test_codec_round_trip():
+    data = {'level': 'Новичок', 'date': date(2026, 10, 20), 'offset': -7, 'other': 'текст', 'flag': True}
+    assert CODEC.decode(CODEC.encode(data)) == data
+
+
+def test_failed_batch_is_kept_and_retried(tmp_path):
+    path = str(tmp_path / 'sessions.db')
+
+    async def main():
+        persistence = SessionPersistence(path, CODEC, update_interval=0.05)
+        await persistence.get_conversations('booking')
+        write = persistence._write
+        calls = []
+
+        def failing_write(*args):
+            calls.append(args)
+            if len(calls) == 1:
+                raise sqlite3.OperationalError('database is locked')
+            return write(*args)
+
+        persistence._write = failing_write
+        await persistence.update_conversation('booking', (1, 1), 2)
+        await persistence.update_user_data(1, {'level': 'Новичок'})
+        await asyncio.sleep(0.2)
+        assert len(calls) == 2
+        assert persistence._conversations == {'booking': {(1, 1): 2}}
+        await persistence.flush()
+
+    asyncio.run(main())
+    conn = sqlite3.connect(path)
+    assert conn.execute('SELECT name, chat_id, user_id, state FROM conversations').fetchall() == [('booking', 1, 1, 2)]
+    assert [CODEC.decode(data) for data, in conn.execute('SELECT data FROM user_sessions')] == [{'level': 'Новичок'}]
@@ -0,0 +1,30 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.error import RetryAfter  # noqa: E402
+
+from ratelimit import PriorityRateLimiter  # noqa: E402
+
+
+def test_expired_pauses_are_forgotten():
+    calls = []
+
+    async def send(chat_id):
+        calls.append(chat_id)
+        if calls.count(chat_id) == 1:
+            raise RetryAfter(1)
+        return True
+
+    async def main():
+        limiter = PriorityRateLimiter(global_rate=100, chat_rate=100)
+        for chat_id in (1, 2):
+            assert await limiter.process_request(send, (chat_id,), {}, 'sendMessage', {'chat_id': chat_id}, None)
+        return limiter
+
+    limiter = asyncio.run(main())
+    assert calls == [1, 1, 2, 2]
+    assert limiter.retries == 2
+    assert limiter._paused_until == {}
@@ -0,0 +1,69 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared import SharedState  # noqa: E402
+from storage import SqliteScheduleStorage  # noqa: E402
+
+
+def test_schedule_changes_of_this_process_do_not_trigger_reload(tmp_path):
+    db = str(tmp_path / 'schedule.db')
+    own = SqliteScheduleStorage(db)
+    other = SqliteScheduleStorage(db)  # как второй процесс с той же базой
+    shared = SharedState(str(tmp_path / 'shared.db'), 'worker-1', own)
+
+    def changed():
+        return shared._call(shared._schedule_changed)
+
+    changed()  # первая проверка только запоминает состояние
+    own.save({'weekly_blocked': {}, 'specific_dates': {}})
+    own.record('weekly_blocked', 'Monday', '12:00-13:00', True)
+    own._call(lambda: None)  # дождаться записи
+    assert not changed()
+    other.record('weekly_blocked', 'Tuesday', '12:00-13:00', True)
+    other._call(lambda: None)
+    assert changed()
+    # Своя и чужая запись между проверками: чужая не должна потеряться
+    own.record('weekly_blocked', 'Monday', '13:00-14:00', True)
+    other.record('weekly_blocked', 'Friday', '13:00-14:00', True)
+    own._call(lambda: None)
+    other._call(lambda: None)
+    assert changed()
+    assert not changed()
+
+    async def close():
+        await shared.close()
+        await own.close()
+        await other.close()
+
+    asyncio.run(close())
+
+
+def test_sessions_live_only_while_conversation_is_active(tmp_path, monkeypatch):
+    storage = SqliteScheduleStorage(str(tmp_path / 'schedule.db'))
+    shared = SharedState(str(tmp_path / 'shared.db'), 'worker-1', storage)
+    shared.session_timeout = 60
+    now = [1000.0]
+    monkeypatch.setattr('shared.time.time', lambda: now[0])
+
+    def load(key):
+        return shared._call(shared._load_session, key)[1]
+
+    shared._call(shared._finish, 1, '1:1', b'data', '{"booking": 2}')
+    assert load('1:1') is not None
+    # Брошенный диалог при загрузке считается завершённым, а затем удаляется из базы
+    now[0] += 61
+    assert load('1:1') is None
+    assert asyncio.run(shared.prune_sessions(60)) == 1
+    # Завершившийся диалог удаляет строку сразу
+    shared._call(shared._finish, 2, '2:2', b'data', '{"admin": 1}')
+    shared._call(shared._finish, 3, '2:2', None, None)
+    assert shared.conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0] == 0
+
+    async def close():
+        await shared.close()
+        await storage.close()
+
+    asyncio.run(close())
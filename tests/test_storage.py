@@ -0,0 +1,152 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+from storage import JsonScheduleStorage, ScheduleJournal, ScheduleWriter, SqliteScheduleStorage  # noqa: E402
+
+EMPTY = {'weekly_blocked': {}, 'specific_dates': {}}
+SLOT = '12:00-13:00'
+
+
+def json_storage(tmp_path, schedule, bookings):
+    path = tmp_path / 'schedule.json'
+    path.write_text(json.dumps(schedule), encoding='utf-8')
+    (tmp_path / 'bookings.jsonl').write_text(''.join(json.dumps(b) + '\n' for b in bookings), encoding='utf-8')
+    return JsonScheduleStorage(str(path), str(tmp_path / 'schedule.journal'), lambda: schedule,
+                               bookings_path=str(tmp_path / 'bookings.jsonl'))
+
+
+def close(*storages):
+    async def run():
+        for storage in storages:
+            await storage.close()
+
+    asyncio.run(run())
+
+
+def test_interrupted_migration_is_repeated(tmp_path):
+    schedule = {'weekly_blocked': {'Monday': ['12:00-13:00']}, 'specific_dates': {}}
+    bookings = [{'date': '2026-10-20', 'slot': '12:00-13:00', 'user_id': 1},
+                {'date': '2026-10-21', 'slot': '12:00-13:00', 'user_id': 2}]
+    source = json_storage(tmp_path, schedule, bookings)
+    db = str(tmp_path / 'schedule.db')
+    # Первый запуск умер, успев перенести одну запись, но не расписание
+    crashed = SqliteScheduleStorage(db)
+    crashed._call(crashed._insert_booking, bookings[0])
+    close(crashed)
+
+    storage = SqliteScheduleStorage(db)
+    assert storage.load(EMPTY, migrate_from=source) == schedule
+    assert [b['user_id'] for b in storage.load_bookings()] == [1, 2]
+    close(storage, source)
+
+
+def test_workers_migrating_together_initialize_once(tmp_path):
+    schedule = {'weekly_blocked': {}, 'specific_dates': {'2026-10-20': ['12:00-13:00']}}
+    bookings = [{'date': '2026-10-20', 'slot': '13:00-14:00', 'user_id': 1}]
+    db = str(tmp_path / 'schedule.db')
+    storages = [SqliteScheduleStorage(db) for _ in range(4)]
+    sources = [json_storage(tmp_path, schedule, bookings) for _ in storages]
+    barrier = threading.Barrier(len(storages))
+    results, errors = [], []
+
+    def start(storage, source):
+        barrier.wait()
+        try:
+            results.append(storage.load(EMPTY, migrate_from=source))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=start, args=pair) for pair in zip(storages, sources)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert results == [schedule] * len(storages)
+    assert storages[0].load_bookings() == bookings
+    assert storages[0].write_counters()[0] == 1
+    close(*storages, *sources)
+
+
+def empty():
+    return {'weekly_blocked': {}, 'specific_dates': {}}
+
+
+def restart(tmp_path):
+    """Новый процесс: читает schedule.json и журнал с диска"""
+    schedule = {}
+    json_storage = JsonScheduleStorage(str(tmp_path / 'schedule.json'), str(tmp_path / 'schedule.journal'),
+                                       lambda: schedule, bookings_path=str(tmp_path / 'bookings.jsonl'))
+    schedule.update(json_storage.load(empty()))
+    return schedule
+
+
+def test_torn_last_journal_line_is_skipped(tmp_path):
+    journal = ScheduleJournal(str(tmp_path / 'schedule.journal'))
+    journal.append('weekly_blocked', 'Monday', SLOT, True)
+    journal.append('specific_dates', '2026-10-20', SLOT, True)
+    journal.close()
+    with open(journal.path, 'a', encoding='utf-8') as f:
+        f.write('{"op": "unblock", "section": "weekly_bl')  # процесс убит посреди записи
+    assert restart(tmp_path) == {'weekly_blocked': {'Monday': [SLOT]}, 'specific_dates': {'2026-10-20': [SLOT]}}
+
+
+def test_leftover_compacting_journal_is_replayed_first(tmp_path):
+    journal = ScheduleJournal(str(tmp_path / 'schedule.journal'))
+    journal.append('weekly_blocked', 'Monday', SLOT, True)
+    journal.append('weekly_blocked', 'Tuesday', SLOT, True)
+    journal.rotate()  # сжатие началось, снимок не записан
+    journal.append('weekly_blocked', 'Monday', SLOT, False)
+    journal.close()
+    assert restart(tmp_path) == {'weekly_blocked': {'Tuesday': [SLOT]}, 'specific_dates': {}}
+    # Второе незавершённое сжатие дописывает журнал к *.compacting в том же порядке
+    journal.append('weekly_blocked', 'Tuesday', SLOT, False)
+    journal.rotate()
+    journal.append('weekly_blocked', 'Friday', SLOT, True)
+    journal.rotate()
+    assert not os.path.exists(journal.path)
+    assert restart(tmp_path) == {'weekly_blocked': {'Friday': [SLOT]}, 'specific_dates': {}}
+
+
+def test_failed_snapshot_keeps_the_journal(tmp_path, monkeypatch):
+    schedule = empty()
+    journal = ScheduleJournal(str(tmp_path / 'schedule.journal'))
+    writer = ScheduleWriter(str(tmp_path / 'schedule.json'), lambda: schedule, journal=journal)
+
+    def fail(path, data):
+        raise OSError('No space left on device')
+
+    async def change():
+        journal.append('specific_dates', '2026-10-20', SLOT, True)
+        storage.apply_slot_op(schedule, 'specific_dates', '2026-10-20', SLOT, True)
+        writer.dirty = True
+        await writer.flush()
+
+    monkeypatch.setattr(storage, 'write_signed', fail)
+    asyncio.run(change())
+    journal.close()
+    assert writer.dirty
+    assert not os.path.exists(tmp_path / 'schedule.json')
+    assert os.path.exists(journal.rotated_path)
+    monkeypatch.undo()  # место на диске появилось, процесс перезапущен
+    assert restart(tmp_path) == {'weekly_blocked': {}, 'specific_dates': {'2026-10-20': [SLOT]}}
+
+
+def test_startup_folds_the_journal_into_the_snapshot(tmp_path):
+    (tmp_path / 'schedule.json').write_text(json.dumps({'weekly_blocked': {'Monday': [SLOT]}, 'specific_dates': {}}),
+                                           encoding='utf-8')
+    journal = ScheduleJournal(str(tmp_path / 'schedule.journal'))
+    journal.append('weekly_blocked', 'Monday', SLOT, False)
+    journal.append('specific_dates', '2026-10-20', SLOT, True)
+    journal.close()
+    expected = {'weekly_blocked': {}, 'specific_dates': {'2026-10-20': [SLOT]}}
+    assert restart(tmp_path) == expected
+    assert not journal.exists()
+    assert json.loads((tmp_path / 'schedule.json').read_text(encoding='utf-8')) == expected
+    assert restart(tmp_path) == expected
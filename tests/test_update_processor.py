@@ -0,0 +1,57 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import CallbackQuery, Update, User  # noqa: E402
+
+from update_processor import PerUserUpdateProcessor  # noqa: E402
+
+
+def make_update(update_id, user_id):
+    user = User(user_id, 'user', False)
+    return Update(update_id, callback_query=CallbackQuery(str(update_id), user, 'chat'))
+
+
+async def submit(processor, updates, handler):
+    """Как Application при concurrent_updates: по задаче на апдейт, в порядке поступления"""
+    tasks = [asyncio.create_task(processor.process_update(update, handler(update))) for update in updates]
+    await asyncio.gather(*tasks)
+
+
+def test_waiting_updates_of_one_user_do_not_hold_slots():
+    finished = []
+
+    async def handler(update):
+        if update.effective_user.id == 1:
+            await asyncio.sleep(0.05)
+        finished.append(update.update_id)
+
+    async def main():
+        processor = PerUserUpdateProcessor(4)
+        # Четыре медленных апдейта одного пользователя и один апдейт другого:
+        # если ждущие апдейты первого заняли слоты, второй ждёт окончания первого апдейта
+        await submit(processor, [make_update(i, 1) for i in range(4)] + [make_update(4, 2)], handler)
+
+    asyncio.run(main())
+    assert finished == [4, 0, 1, 2, 3]
+
+
+def test_updates_of_one_user_are_processed_in_order():
+    order = {}
+
+    async def handler(update):
+        await asyncio.sleep(0.001 * (update.update_id % 3))
+        order.setdefault(update.effective_user.id, []).append(update.update_id)
+
+    async def main():
+        processor = PerUserUpdateProcessor(2)
+        updates = [make_update(i, i % 5) for i in range(200)]
+        await submit(processor, updates, handler)
+        assert processor.active_keys == 0
+
+    asyncio.run(main())
+    for user_id, ids in order.items():
+        assert ids == sorted(ids), user_id
+    assert sum(len(ids) for ids in order.values()) == 200
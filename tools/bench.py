@@ -0,0 +1,173 @@
+"""Микробенчмарки горячих путей расписания и клавиатур.
+
+Меряет функции main.py на синтетических расписаниях разного размера
+(от пустого до тысяч записей в specific_dates) и пишет результаты в JSON.
+С --compare сравнивает с сохранённым baseline и завершается с кодом 1,
+если что-то стало медленнее порога.
+
+    python tools/bench.py --output bench_baseline.json
+    python tools/bench.py --compare bench_baseline.json --threshold 15
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZES = [0, 10, 100, 1000, 5000]
+
+
+def import_main(workdir):
+    """Импортирует main.py так, чтобы его файлы (schedule.json и т.п.) создавались во workdir"""
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import main
+    return main
+
+
+def synthetic_schedule(main, size, seed=42):
+    rng = random.Random(seed)
+    weekly = {day: sorted(rng.sample(main.TIME_SLOTS, rng.randint(0, 5))) for day in main.WEEKDAYS_EN}
+    today = date.today()
+    specific = {}
+    # Большая часть дат — прошлое, которое копится месяцами; остальное — ближайшие недели
+    for i in range(size):
+        offset = -rng.randint(1, 3 * 365) if i % 5 else rng.randint(0, 20)
+        key = (today + timedelta(days=offset)).isoformat()
+        specific[key] = sorted(set(specific.get(key, [])) | set(rng.sample(main.TIME_SLOTS, rng.randint(1, 6))))
+    return {'weekly_blocked': weekly, 'specific_dates': specific}
+
+
+def load(main, schedule):
+    main.SCHEDULE.clear()
+    main.SCHEDULE.update(schedule)
+    main.rebuild_schedule_index()
+
+
+def measure(fn, min_time=0.2, repeat=5):
+    """Лучшее из repeat прогонов, нс на вызов"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / repeat:
+            break
+        number *= 2
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, time.perf_counter() - start)
+    return best / number * 1e9
+
+
+def benchmarks(main):
+    today = date.today()
+    dates = [today + timedelta(days=i) for i in range(21)]
+    slots = main.TIME_SLOTS
+    blocked_mask = main.slots_to_mask(slots[::3])
+
+    def is_slot_blocked():
+        for d in dates:
+            for s in slots:
+                main.is_slot_blocked(d, s)
+
+    def get_available_slots():
+        for d in dates:
+            main.get_available_slots(d)
+
+    def get_available_dates():
+        for offset in (0, 7, 14):
+            main.get_available_dates(offset)
+
+    return {
+        # на одну дату / слот
+        'is_slot_blocked': (is_slot_blocked, len(dates) * len(slots)),
+        'get_available_slots': (get_available_slots, len(dates)),
+        'get_available_dates': (get_available_dates, 3),
+        # клавиатуры: построение с нуля и попадание в кэш
+        'get_days_keyboard': (lambda: main.get_days_keyboard.__wrapped__(0), 1),
+        'get_days_keyboard.cached': (lambda: main.get_days_keyboard(0), 1),
+        'get_time_keyboard': (lambda: main.get_time_keyboard.__wrapped__(today), 1),
+        'get_time_keyboard.cached': (lambda: main.get_time_keyboard(today), 1),
+        'get_time_toggle_keyboard': (lambda: main.get_time_toggle_keyboard.__wrapped__(blocked_mask), 1),
+        'get_time_toggle_keyboard.cached': (lambda: main.get_time_toggle_keyboard(blocked_mask), 1),
+        # просмотр расписания: сборка блоков, склейка одной страницы, готовая страница
+        'admin_view.build': (lambda: main.build_schedule_view.__wrapped__(main.SCHEDULE_VERSION), 1),
+        'admin_view.page': (lambda: main.render_schedule_page.__wrapped__(main.SCHEDULE_VERSION, 0), 1),
+        'admin_view.cached': (lambda: main.get_schedule_view(0), 1),
+    }
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        main = import_main(workdir)
+        results = {}
+        for size in args.sizes:
+            load(main, synthetic_schedule(main, size))
+            for name, (fn, calls) in benchmarks(main).items():
+                if args.filter and args.filter not in name:
+                    continue
+                key = f'{name}[{size}]'
+                results[key] = measure(fn, args.min_time) / calls
+                print(f'{key:<40} {results[key]:>12.0f} ns')
+        asyncio.run(main.SCHEDULE_STORAGE.close())
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'unit': 'ns/call',
+        },
+        'results': results,
+    }
+
+
+def compare(current, baseline, threshold):
+    print(f"\n{'benchmark':<40} {'baseline':>12} {'current':>12} {'change':>8}")
+    regressions = []
+    for key, value in current['results'].items():
+        old = baseline['results'].get(key)
+        if old is None:
+            print(f'{key:<40} {"-":>12} {value:>12.0f} {"new":>8}')
+            continue
+        change = (value - old) / old * 100
+        mark = ' !' if change > threshold else ''
+        print(f'{key:<40} {old:>12.0f} {value:>12.0f} {change:>+7.1f}%{mark}')
+        if change > threshold:
+            regressions.append(key)
+    if regressions:
+        print(f'\n{len(regressions)} regression(s) over {threshold}%: {", ".join(regressions)}')
+    return not regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=20.0, help='allowed slowdown in percent')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='numbers of specific_dates entries')
+    parser.add_argument('--filter', help='run only benchmarks whose name contains this string')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds per measurement')
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    if args.compare:
+        args.compare = os.path.abspath(args.compare)
+    current = run(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        sys.exit(0 if compare(current, baseline, args.threshold) else 1)
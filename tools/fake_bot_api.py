@@ -0,0 +1,320 @@
+"""Локальная замена Telegram Bot API для замеров без обращения к настоящему Telegram.
+
+Бот подключается к ней через TELEGRAM_API_URL=http://127.0.0.1:<port>/bot.
+Поддерживается то подмножество методов, которое использует бот. Апдейты
+кладутся через push_update() и отдаются либо через getUpdates (long polling),
+либо POST-запросом на вебхук, если бот вызвал setWebhook.
+"""
+import asyncio
+import itertools
+import json
+import os
+import socket
+import sys
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+BOT_USER = {'id': 123, 'is_bot': True, 'first_name': 'Test Bot', 'username': 'test_bot'}
+
+
+def _decode_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def _parse_multipart(body, content_type):
+    boundary = content_type.split('boundary=', 1)[1].strip('"').encode()
+    params = {}
+    for part in body.split(b'--' + boundary):
+        head, _, payload = part.partition(b'\r\n\r\n')
+        if b'name="' not in head:
+            continue
+        name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode()
+        payload = payload[:-2] if payload.endswith(b'\r\n') else payload
+        if b'filename="' in head:
+            params[name] = {'size': len(payload)}
+        else:
+            params[name] = _decode_value(payload.decode('utf-8'))
+    return params
+
+
+def parse_params(headers, body):
+    content_type = headers.get('content-type', '')
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+    if content_type.startswith('multipart/form-data'):
+        return _parse_multipart(body, content_type)
+    return {k: _decode_value(v) for k, v in parse_qsl(body.decode('utf-8'), keep_blank_values=True)}
+
+
+async def read_http_message(reader):
+    """Читает запрос/ответ HTTP/1.1: (первая строка, заголовки, тело). None при закрытии"""
+    start = await reader.readline()
+    if not start:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = b''
+    if 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    return start.decode('latin-1').strip(), headers, body
+
+
+def http_response(status, payload, reason='OK'):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    return (f'HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: keep-alive\r\n\r\n').encode() + body
+
+
+class FakeBotAPI:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.calls = []  # (время, метод, параметры, размер тела запроса)
+        self.method_counts = {}
+        self.bytes_received = 0
+        self.webhook_url = None
+        self.webhook_secret = None
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000)
+        self._new_updates = asyncio.Event()
+        self._listeners = []
+        self._server = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}/bot'
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    # --- апдейты ---
+
+    def push_update(self, update):
+        update = dict(update, update_id=next(self._update_ids))
+        if self.webhook_url:
+            asyncio.get_running_loop().create_task(self._post_webhook(update))
+        else:
+            self._updates.append(update)
+            self._new_updates.set()
+        return update
+
+    async def _post_webhook(self, update):
+        url = urlsplit(self.webhook_url)
+        reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+        body = json.dumps(update).encode('utf-8')
+        headers = (f'POST {url.path or "/"} HTTP/1.1\r\nHost: {url.netloc}\r\n'
+                   f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n')
+        if self.webhook_secret:
+            headers += f'X-Telegram-Bot-Api-Secret-Token: {self.webhook_secret}\r\n'
+        writer.write(headers.encode() + b'\r\n' + body)
+        await writer.drain()
+        response = await read_http_message(reader)
+        writer.close()
+        if response is None or not response[0].split()[1].startswith('2'):
+            raise RuntimeError(f'Webhook rejected update: {response and response[0]}')
+
+    async def _get_updates(self, params):
+        offset = params.get('offset') or 0
+        self._updates = [u for u in self._updates if u['update_id'] >= offset]
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout=float(params.get('timeout') or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:int(params.get('limit') or 100)]
+
+    # --- ожидание ответов бота ---
+
+    def wait_for_call(self, predicate):
+        """Future, который завершится на первом вызове API, для которого predicate(method, params) истинно"""
+        future = asyncio.get_running_loop().create_future()
+        self._listeners.append((predicate, future))
+        return future
+
+    def _notify(self, received_at, method, params):
+        for item in list(self._listeners):
+            predicate, future = item
+            if not future.done() and predicate(method, params):
+                future.set_result((received_at, method, params))
+                self._listeners.remove(item)
+
+    # --- методы Bot API ---
+
+    def _message(self, params, **extra):
+        chat_id = params.get('chat_id')
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+        }
+        message.update(extra)
+        return message
+
+    async def _call(self, method, params):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            return await self._get_updates(params)
+        if method == 'setWebhook':
+            self.webhook_url = params.get('url')
+            self.webhook_secret = params.get('secret_token')
+            return True
+        if method == 'deleteWebhook':
+            self.webhook_url = None
+            return True
+        if method in ('sendMessage', 'editMessageText'):
+            message = self._message(params, text=params.get('text', ''))
+            if params.get('reply_markup'):
+                message['reply_markup'] = params['reply_markup']
+            if method == 'editMessageText' and 'message_id' in params:
+                message['message_id'] = params['message_id']
+            return message
+        if method == 'sendPhoto':
+            photo = params.get('photo')
+            file_id = photo if isinstance(photo, str) and not photo.startswith('http') else 'fake-photo-file-id'
+            return self._message(params, caption=params.get('caption'),
+                                 photo=[{'file_id': file_id, 'file_unique_id': 'fake-photo', 'width': 800, 'height': 600}])
+        if method in ('editMessageReplyMarkup', 'editMessageCaption'):
+            message = self._message(params)
+            message['message_id'] = params.get('message_id')
+            return message
+        if method in ('answerCallbackQuery', 'deleteMessage', 'close', 'logOut'):
+            return True
+        raise KeyError(method)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await read_http_message(reader)
+                if request is None:
+                    break
+                start, headers, body = request
+                self.bytes_received += len(body)
+                path = start.split()[1]
+                method = path.rstrip('/').rsplit('/', 1)[-1]
+                params = parse_params(headers, body)
+                received_at = time.perf_counter()
+                self.calls.append((received_at, method, params, len(body)))
+                self.method_counts[method] = self.method_counts.get(method, 0) + 1
+                try:
+                    result = await self._call(method, params)
+                    response = http_response(200, {'ok': True, 'result': result})
+                except KeyError:
+                    response = http_response(404, {'ok': False, 'error_code': 404,
+                                                   'description': 'Not Found: method not found'}, 'Not Found')
+                writer.write(response)
+                await writer.drain()
+                self._notify(received_at, method, params)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass  # клиент отключился или сервер останавливается
+        finally:
+            writer.close()
+
+
+# --- конструкторы апдейтов ---
+
+def make_user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+
+def message_update(user_id, text):
+    entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []
+    return {'message': {
+        'message_id': 1,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': make_user(user_id),
+        'text': text,
+        'entities': entities,
+    }}
+
+
+def callback_update(user_id, data, message_id=1, photo=False):
+    """Нажатие кнопки под сообщением бота; photo=True — под фото с подписью (приветствие)"""
+    message = {
+        'message_id': message_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': BOT_USER,
+    }
+    if photo:
+        message.update(caption='...', photo=[{'file_id': 'fake-photo-file-id', 'file_unique_id': 'fake-photo',
+                                              'width': 800, 'height': 600}])
+    else:
+        message['text'] = '...'
+    return {'callback_query': {
+        'id': f'{user_id}-{time.perf_counter_ns()}',
+        'from': make_user(user_id),
+        'chat_instance': str(user_id),
+        'data': data,
+        'message': message,
+    }}
+
+
+# --- запуск бота против заглушки ---
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+async def start_bot(api, workdir, mode='polling', wait_ready=True, **env):
+    """Запускает main.py отдельным процессом против api и ждёт готовности.
+    wait_ready=False — не ждать (процесс без getUpdates, например не лидер в SHARED_STATE_DB)"""
+    port = free_port()
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN='123:TEST',
+        TELEGRAM_API_URL=api.url,
+        BOT_MODE=mode,
+        PORT=str(port),
+        WEBHOOK_URL=f'http://127.0.0.1:{port}',
+        WEBHOOK_SECRET='fake-api-secret',
+        **{k: str(v) for k, v in env.items()},
+    )
+    bot = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, 'main.py'), cwd=workdir, env=env,
+                                               stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    ready_method = 'setWebhook' if mode == 'webhook' else 'getUpdates'
+    deadline = time.monotonic() + 30
+    while wait_ready and ready_method not in api.method_counts:
+        if time.monotonic() > deadline or bot.returncode is not None:
+            bot.terminate()
+            raise RuntimeError('Bot did not start')
+        await asyncio.sleep(0.05)
+    if mode == 'webhook':
+        await asyncio.sleep(0.5)  # сервер вебхука поднимается сразу после setWebhook
+    return bot
+
+
+async def stop_bot(bot):
+    bot.terminate()
+    await bot.wait()
@@ -0,0 +1,167 @@
+"""Нагрузочный тест воронки записи против локальной замены Bot API.
+
+N виртуальных пользователей одновременно проходят booking_conv
+(/start → start_booking → уровень → инструмент → часовой пояс → день → время),
+а админ параллельно переключает слоты в admin_conv. Каждый шаг ждёт ответа
+бота, поэтому нагрузка замкнутая. В конце печатается пропускная способность,
+задержки p50/p95/p99 по каждому состоянию диалога и число запросов к Bot API
+и байт на одну успешную запись (--nav send|edit сравнивает режимы навигации).
+--workers N запускает N процессов бота с общим SHARED_STATE_DB.
+
+    python tools/loadtest.py --users 200 --api-rate 1000
+"""
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+
+from fake_bot_api import FakeBotAPI, callback_update, message_update, percentile, start_bot, stop_bot
+
+ADMIN_ID = 5094488507
+USER_ID_BASE = 100_000
+REPLY_METHODS = ('sendMessage', 'sendPhoto', 'editMessageText', 'editMessageReplyMarkup')
+
+
+def callback_data(params, prefix):
+    markup = params.get('reply_markup') or {}
+    return [button['callback_data'] for row in markup.get('inline_keyboard', []) for button in row
+            if button.get('callback_data', '').startswith(prefix)]
+
+
+class LoadTest:
+    def __init__(self, api):
+        self.api = api
+        self.latencies = {}  # состояние -> [мс]
+        self.outcomes = {}
+        self.booked_users = set()
+
+    def count(self, outcome):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    async def step(self, state, chat_id, update, reply_filter=None):
+        """Отправляет апдейт и ждёт ответа бота с клавиатурой (уведомления админу без неё не считаются)"""
+        def predicate(method, params):
+            if method not in REPLY_METHODS or params.get('chat_id') != chat_id:
+                return False
+            if reply_filter is not None:
+                return reply_filter(method, params)
+            return 'reply_markup' in params or method == 'editMessageReplyMarkup'
+        reply = self.api.wait_for_call(predicate)
+        sent_at = time.perf_counter()
+        self.api.push_update(update)
+        received_at, method, params = await asyncio.wait_for(reply, timeout=60)
+        self.latencies.setdefault(state, []).append((received_at - sent_at) * 1000)
+        return params
+
+    async def user(self, user_id):
+        await self.step('start', user_id, message_update(user_id, '/start'))
+        await self.step('start_booking', user_id, callback_update(user_id, 'start_booking', photo=True))
+        await self.step('level', user_id, callback_update(user_id, random.choice(['level_beginner', 'level_experienced'])))
+        await self.step('instrument', user_id, callback_update(user_id, random.choice(['inst_electric', 'inst_acoustic'])))
+        days = await self.step('timezone', user_id, callback_update(user_id, 'tz_utc3'))
+        dates = callback_data(days, 'date_')
+        if not dates:
+            self.count('no_dates')
+            return
+        times = await self.step('day', user_id, callback_update(user_id, random.choice(dates)))
+        slots = callback_data(times, 'time_')
+        if not slots:
+            self.count('no_slots')
+            return
+        result = await self.step('time', user_id, callback_update(user_id, random.choice(slots)))
+        if 'Заявка принята' in result.get('text', ''):
+            self.count('booked')
+            self.booked_users.add(user_id)
+        else:
+            self.count('slot_taken')
+
+    async def admin(self, stop, toggles_per_round):
+        await self.step('admin', ADMIN_ID, message_update(ADMIN_ID, '/admin'))
+        while not stop.is_set():
+            await self.step('admin_menu', ADMIN_ID, callback_update(ADMIN_ID, 'admin_manage'))
+            days = await self.step('admin_type', ADMIN_ID, callback_update(ADMIN_ID, 'manage_specific'))
+            dates = callback_data(days, 'adate_')
+            if not dates:
+                break
+            slots = await self.step('admin_day', ADMIN_ID, callback_update(ADMIN_ID, random.choice(dates)))
+            toggles = callback_data(slots, 'toggle_')
+            for _ in range(toggles_per_round):
+                await self.step('admin_toggle', ADMIN_ID, callback_update(ADMIN_ID, random.choice(toggles)),
+                                lambda m, p: m == 'editMessageReplyMarkup')
+            await self.step('admin_done', ADMIN_ID, callback_update(ADMIN_ID, 'admin_done'))
+
+
+async def run(args):
+    api = await FakeBotAPI().start()
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(BOT_API_RATE=args.api_rate, NAV_MODE=args.nav, BOT_API_CHAT_RATE=args.chat_rate,
+                   ADMIN_DIGEST_INTERVAL=3600)
+        if args.workers > 1:
+            env['SHARED_STATE_DB'] = 'shared.db'
+        bots = [await start_bot(api, workdir, args.mode, WORKER_ID='worker-0', **env)]
+        # Остальные процессы не лидеры и getUpdates не вызывают
+        for i in range(1, args.workers):
+            bots.append(await start_bot(api, workdir, args.mode, wait_ready=False, WORKER_ID=f'worker-{i}', **env))
+        try:
+            test = LoadTest(api)
+            stop = asyncio.Event()
+            admin = asyncio.create_task(test.admin(stop, args.admin_toggles)) if args.admin_toggles else None
+            started = time.perf_counter()
+
+            async def user(i):
+                await asyncio.sleep(random.uniform(0, args.ramp))
+                await test.user(USER_ID_BASE + i)
+
+            await asyncio.gather(*(user(i) for i in range(args.users)))
+            elapsed = time.perf_counter() - started
+            stop.set()
+            if admin is not None:
+                await admin
+        finally:
+            for bot in bots:
+                await stop_bot(bot)
+            await api.stop()
+
+    total = sum(len(v) for v in test.latencies.values())
+    print(f"users={args.users} mode={args.mode} nav={args.nav} workers={args.workers} elapsed={elapsed:.2f}s updates={total} "
+          f"throughput={total / elapsed:.1f} upd/s funnels={test.outcomes.get('booked', 0) / elapsed:.2f}/s")
+    print(f"outcomes: {test.outcomes}")
+    print(f"{'state':<14} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for state, values in test.latencies.items():
+        print(f"{state:<14} {len(values):>6} {percentile(values, 50):>8.1f} {percentile(values, 95):>8.1f} "
+              f"{percentile(values, 99):>8.1f}")
+    print(f"Bot API calls: {dict(sorted(api.method_counts.items()))}")
+    report_user_calls(api, test.booked_users)
+
+
+def report_user_calls(api, booked_users):
+    """Запросы бота в чаты пользователей, дошедших до записи, в среднем на одну запись"""
+    if not booked_users:
+        return
+    counts, sizes = {}, {}
+    for _, method, params, size in api.calls:
+        if method == 'answerCallbackQuery':
+            chat_id = int(str(params.get('callback_query_id')).split('-')[0])  # id колбэка — '<user_id>-<ns>'
+        else:
+            chat_id = params.get('chat_id')
+        if chat_id in booked_users:
+            counts[method] = counts.get(method, 0) + 1
+            sizes[method] = sizes.get(method, 0) + size
+    booked = len(booked_users)
+    print(f"per booking: {sum(counts.values()) / booked:.2f} calls, {sum(sizes.values()) / booked:.0f} request bytes")
+    for method in sorted(counts):
+        print(f"  {method:<24} {counts[method] / booked:>6.2f} calls {sizes[method] / booked:>8.0f} bytes")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--ramp', type=float, default=1.0, help='users start uniformly within this many seconds')
+    parser.add_argument('--mode', choices=['polling', 'webhook'], default='polling')
+    parser.add_argument('--api-rate', type=float, default=30, help='global Bot API budget of the bot (BOT_API_RATE)')
+    parser.add_argument('--chat-rate', type=float, default=1, help='per-chat budget of the bot (BOT_API_CHAT_RATE)')
+    parser.add_argument('--nav', choices=['edit', 'send'], default='edit', help='navigation mode of the bot (NAV_MODE)')
+    parser.add_argument('--workers', type=int, default=1, help='bot processes sharing SHARED_STATE_DB (polling only)')
+    parser.add_argument('--admin-toggles', type=int, default=10, help='slot toggles per admin round, 0 disables the admin')
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,50 @@
+"""Сравнение задержки ответа бота в режимах polling и webhook.
+
+Запускает локальную замену Bot API (fake_bot_api.py) и бота (main.py) как
+отдельный процесс, шлёт /start от разных пользователей и меряет время от
+отправки апдейта до первого ответа бота этому пользователю.
+
+    python tools/webhook_latency.py --requests 100
+"""
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+
+from fake_bot_api import FakeBotAPI, message_update, percentile, start_bot, stop_bot
+
+REPLY_METHODS = ('sendMessage', 'sendPhoto')
+
+
+async def measure(mode, requests, workdir):
+    api = await FakeBotAPI().start()
+    bot = await start_bot(api, workdir, mode)
+    try:
+        latencies = []
+        for i in range(requests):
+            user_id = 10_000 + i
+            reply = api.wait_for_call(lambda m, p, uid=user_id: m in REPLY_METHODS and p.get('chat_id') == uid)
+            sent_at = time.perf_counter()
+            api.push_update(message_update(user_id, '/start'))
+            received_at, _, _ = await asyncio.wait_for(reply, timeout=30)
+            latencies.append((received_at - sent_at) * 1000)
+        return latencies
+    finally:
+        await stop_bot(bot)
+        await api.stop()
+
+
+async def run(args):
+    print(f"{'mode':<8} {'n':>5} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'mean ms':>8}")
+    for mode in ('polling', 'webhook'):
+        with tempfile.TemporaryDirectory() as workdir:
+            latencies = await measure(mode, args.requests, workdir)
+        print(f"{mode:<8} {len(latencies):>5} {percentile(latencies, 50):>8.2f} {percentile(latencies, 95):>8.2f} "
+              f"{max(latencies):>8.2f} {statistics.mean(latencies):>8.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=50)
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,88 @@
+import asyncio
+import contextvars
+import sys
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Время начала обработки текущего апдейта (perf_counter), для логов и замеров
+UPDATE_STARTED = contextvars.ContextVar('update_started', default=None)
+
+
+def update_key(update):
+    """(chat_id, user_id) апдейта — как ключ ConversationHandler по умолчанию; None, если его нет"""
+    if not isinstance(update, Update):
+        return None
+    chat = update.effective_chat
+    user = update.effective_user
+    if chat is None and user is None:
+        return None
+    return (chat.id if chat else None, user.id if user else None)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка апдейтов с сохранением порядка внутри пользователя.
+
+    Апдейты разных пользователей обрабатываются одновременно (не больше
+    max_concurrent_updates), а апдейты одного пользователя в одном чате —
+    строго по очереди, как при последовательной обработке. Ключ совпадает с
+    ключом ConversationHandler по умолчанию (chat_id, user_id), поэтому
+    переходы состояний диалогов не перемешиваются.
+
+    Сначала апдейт встаёт в очередь своего ключа (asyncio.Lock — FIFO) и
+    только первым в ней занимает общий слот параллельности. Иначе апдейты,
+    ждущие предыдущий апдейт того же пользователя, держали бы слоты и
+    задерживали остальных, а неупорядоченный asyncio.Semaphore в Python 3.9
+    мог бы пропустить более поздний апдейт вперёд. Семафор BaseUpdateProcessor
+    (process_update у PTB финальный) захватывается раньше очереди, поэтому
+    ему передан лимит, который никогда не достигается, а настоящий лимит
+    limit действует в do_process_update.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(sys.maxsize)
+        self.limit = max_concurrent_updates
+        self._locks = {}  # ключ -> [asyncio.Lock, число ожидающих]
+        self._slots = None  # создаётся в event loop, который обрабатывает апдейты
+        self.profiler = None  # UpdateProfiler, если профилирование включено
+        self.shared_state = None  # SharedState в режиме нескольких процессов
+
+    async def do_process_update(self, update, coroutine):
+        if self._slots is None:
+            self._slots = asyncio.BoundedSemaphore(self.limit)
+        key = update_key(update)
+        if key is None:
+            async with self._slots:
+                await self._process(update, coroutine)
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    await self._process(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def _process(self, update, coroutine):
+        UPDATE_STARTED.set(time.perf_counter())
+        if self.profiler is not None:
+            coroutine = self.profiler.run(update, coroutine)
+        if self.shared_state is not None:
+            coroutine = self.shared_state.run(update, coroutine)
+        await coroutine
+
+    @property
+    def active_keys(self):
+        return len(self._locks)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass